@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''
+JSON API for mobile and widget clients, mounted at /api/v1
+'''
+import json
+import datetime
+from flask import Blueprint, request, abort
+from flask.ext.login import login_required, current_user
+from main import app
+import database
+import common
+
+api = Blueprint('api', __name__)
+
+BETS_PER_PAGE = 100
+
+def _default(value):
+	if isinstance(value, datetime.datetime):
+		return value.strftime('%Y-%m-%dT%H:%M:%S')
+	raise TypeError(repr(value))
+
+def _response(data, etag=None):
+	'''
+	Compact JSON response, answered with 304 when the client has it already
+	Without etag the ETag is a hash of the body
+	'''
+	response = app.response_class(
+		json.dumps(data, separators=(',', ':'), default=_default),
+		mimetype='application/json'
+	)
+	if etag:
+		response.set_etag(etag)
+	else:
+		response.add_etag()
+	response.headers['Cache-Control'] = 'private, no-cache'
+	return response.make_conditional(request)
+
+def _not_modified(etag):
+	''' 304 response if the client has the version in etag, else None '''
+	if request.if_none_match.contains(etag):
+		response = app.response_class(status=304)
+		response.set_etag(etag)
+		response.headers['Cache-Control'] = 'private, no-cache'
+		return response
+
+def _match(match):
+	return {
+		'id': match.match_id,
+		'time': match.match_time,
+		'home': match.home_team_id,
+		'away': match.away_team_id,
+		'home_goals': match.home_goals,
+		'away_goals': match.away_goals,
+		'overtime': match.overtime,
+		'played': bool(match.played)
+	}
+
+def _teams():
+	''' Every team keyed by team id, clients resolve match teams from here '''
+	return {
+		team.team_id: {'name': team.name, 'abbreviation': team.abbreviation, 'logo': team.logo}
+		for team in database.get_team_registry().itervalues()
+	}
+
+@api.route('/me')
+@login_required
+def me():
+	return _response({'id': current_user.id, 'username': current_user.username})
+
+@api.route('/matches')
+@login_required
+def matches():
+	'''
+	Matches of one month with ?month=YYYY-MM, of one team with ?team=<id>,
+	otherwise all matches
+	'''
+	month = request.args.get('month')
+	team_id = request.args.get('team', type=int)
+	if month:
+		try:
+			dt = datetime.datetime.strptime(month, '%Y-%m')
+		except ValueError:
+			abort(400)
+		# Matches of a month change only with the month version
+		etag = 'matches-{}-{}-{}'.format(
+			month,
+			database.get_version(database.month_version_name(dt.year, dt.month)),
+			database.get_version('teams')
+		)
+		response = _not_modified(etag)
+		if response:
+			return response
+		rows = database.get_matches_by_month(dt)
+	elif team_id:
+		etag = None
+		rows = database.get_matches_by_team(team_id)
+	else:
+		etag = None
+		rows = database.get_matches()
+	return _response({
+		'teams': _teams(),
+		'matches': [_match(match) for match in rows]
+	}, etag)
+
+@api.route('/matches/<int:match_id>/bets')
+@login_required
+def match_bets(match_id):
+	''' All bets of one match '''
+	if database.get_match(match_id) is None:
+		abort(404)
+	return _response({
+		'match_id': match_id,
+		'bets': [
+			{
+				'user_id': bet.user_id,
+				'username': bet.user.username,
+				'home_goals': bet.home_goals,
+				'away_goals': bet.away_goals
+			}
+			for bet in database.get_all_bets(match_id, eager=True)
+		]
+	})
+
+@api.route('/users/<int:user_id>/bets')
+@login_required
+def user_bets(user_id):
+	'''
+	Bets of user with points in match order, paged with ?cursor=
+	The cursor of the next page is in the response, null on the last page
+	'''
+	limit = max(1, min(request.args.get('limit', BETS_PER_PAGE, type=int), BETS_PER_PAGE))
+	# One extra row tells if there is a next page
+	rows = database.get_user_bets_with_points(
+		user_id,
+		after=common.decode_cursor(request.args.get('cursor')),
+		limit=limit + 1
+	)
+	cursor = None
+	if len(rows) > limit:
+		rows = rows[:limit]
+		cursor = common.encode_cursor(rows[-1][1].match_time, rows[-1][1].match_id)
+	return _response({
+		'user_id': user_id,
+		'bets': [
+			{
+				'match': _match(match),
+				'home_goals': bet.home_goals,
+				'away_goals': bet.away_goals,
+				'points': points
+			}
+			for bet, match, points in rows
+		],
+		'cursor': cursor
+	})
+
+@api.route('/ranking')
+@login_required
+def ranking():
+	''' Ranking in order, first is the leader '''
+	# Ranking changes only when points are written
+	etag = 'ranking-{}'.format(database.get_version('scoring'))
+	response = _not_modified(etag)
+	if response:
+		return response
+	ranking = database.get_ranking()
+	return _response({
+		'ranking': [
+			dict(ranking[rank], rank=rank)
+			for rank in sorted(ranking)
+		]
+	}, etag)
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks run against a temporary database filled with generated data
+'''
+import os
+import random
+import datetime
+import tempfile
+import threading
+import time
+import contextlib
+import json
+import math
+import subprocess
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from main import app
+import database
+import common
+import passwords
+
+db = database.db
+
+@contextlib.contextmanager
+def temporary_database(profile=None):
+	'''
+	Use a new empty database file inside the block
+	The configured database and SQLite profile are restored afterwards
+
+	Keyword arguments:
+	profile	-- name of the SQLite profile, default is the configured one
+	'''
+	fd, path = tempfile.mkstemp(suffix='.sqlite')
+	os.close(fd)
+	saved = app.config['SQLALCHEMY_DATABASE_URI'], app.config['SQLITE_PROFILE']
+	db.session.remove()
+	database.read_session.remove()
+	app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+	app.config['SQLITE_PROFILE'] = profile or saved[1]
+	database.clear_caches()
+	try:
+		with app.app_context():
+			database.migrate()
+		yield path
+	finally:
+		db.session.remove()
+		database.read_session.remove()
+		db.get_read_engine().dispose()
+		db.engine.dispose()
+		app.config['SQLALCHEMY_DATABASE_URI'], app.config['SQLITE_PROFILE'] = saved
+		database.clear_caches()
+		for name in (path, path + '-wal', path + '-shm'):
+			if os.path.exists(name):
+				os.remove(name)
+
+# Password of every generated user
+PASSWORD = u'benchmark'
+
+def generate(users=200, teams=10, matches=180, bets=None, seed=1):
+	'''
+	Fill the database with random users, teams, matches and bets
+	The same seed always generates the same data
+	The first half of the matches is played, none of them is scored
+
+	Keyword arguments:
+	bets	-- number of bets, default is every user betting every match
+	'''
+	rnd = random.Random(seed)
+	pwhash = passwords.hash_password(PASSWORD)
+	start = datetime.datetime(2016, 9, 1, 18, 30)
+	db.session.bulk_insert_mappings(database.Role, [{'id': 1, 'name': 'basic'}])
+	db.session.bulk_insert_mappings(database.User, [
+		{
+			'id': user_id,
+			'username': 'user{}'.format(user_id),
+			'password': pwhash,
+			'email': 'user{}@example.com'.format(user_id),
+			'role_id': 1,
+			'confirmed': True
+		}
+		for user_id in range(1, users + 1)
+	])
+	db.session.bulk_insert_mappings(database.Team, [
+		{'team_id': team_id, 'name': 'Team {}'.format(team_id)}
+		for team_id in range(1, teams + 1)
+	])
+	rows = list()
+	for match_id in range(1, matches + 1):
+		home, away = rnd.sample(range(1, teams + 1), 2)
+		played = match_id <= matches / 2
+		rows.append({
+			'match_id': match_id,
+			'match_time': start + datetime.timedelta(days=match_id / 3),
+			'home_team_id': home,
+			'away_team_id': away,
+			'home_goals': rnd.randint(0, 6) if played else 0,
+			'away_goals': rnd.randint(0, 6) if played else 0,
+			'overtime': rnd.randint(0, 1) if played else 0,
+			'played': played,
+			'points_shared': False
+		})
+	db.session.bulk_insert_mappings(database.Match, rows)
+	pairs = range(users * matches)
+	if bets is not None and bets < len(pairs):
+		pairs = sorted(rnd.sample(pairs, bets))
+	db.session.bulk_insert_mappings(database.Bet, [
+		{
+			'user_id': pair / matches + 1,
+			'match_id': pair % matches + 1,
+			'home_goals': rnd.randint(0, 5),
+			'away_goals': rnd.randint(0, 5)
+		}
+		for pair in pairs
+	])
+	db.session.commit()
+	return 1 + users + teams + matches + len(pairs)
+
+def _percentiles(latencies):
+	''' Latencies in seconds as dictionary of percentiles '''
+	latencies = sorted(latencies) or [0.0]
+	return {
+		'reads': len(latencies),
+		'p50': latencies[int(len(latencies) * 0.50)],
+		'p95': latencies[int(len(latencies) * 0.95)],
+		'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+		'max': latencies[-1]
+	}
+
+def _read_while(readers, work):
+	'''
+	Read ranking and calendar from reader threads until work returns
+	Return percentiles of the read latencies and the number of failed reads
+	'''
+	month = datetime.datetime(2016, 10, 1)
+	latencies = list()
+	errors = [0]
+	lock = threading.Lock()
+	stop = threading.Event()
+
+	def read():
+		while not stop.is_set():
+			start = time.time()
+			try:
+				with app.app_context():
+					# Measure the queries, not the cache
+					database._ranking_cache.clear()
+					database.get_ranking()
+					database.get_matches_by_month(month)
+			except OperationalError:
+				with lock:
+					errors[0] += 1
+				continue
+			elapsed = time.time() - start
+			with lock:
+				latencies.append(elapsed)
+
+	threads = [threading.Thread(target=read) for i in range(readers)]
+	for thread in threads:
+		thread.start()
+	try:
+		work()
+	finally:
+		stop.set()
+		for thread in threads:
+			thread.join()
+	result = _percentiles(latencies)
+	result['errors'] = errors[0]
+	return result
+
+def _unscore():
+	''' Remove all points so that played matches are scored again '''
+	database.Points.query.delete()
+	database.Standing.query.delete()
+	database.Match.query.filter_by(played=1).update({'points_shared': 0})
+	db.session.commit()
+
+def _score(runs):
+	''' Score every played match again, runs times '''
+	for i in range(runs):
+		with app.app_context():
+			_unscore()
+			database.check_points()
+
+def reader_latency(readers=4, runs=3, users=300, matches=300):
+	'''
+	Measure ranking and calendar read latency while bets are scored
+	Every SQLite profile is measured on its own generated database
+	Return dictionary of profile: {'idle': result, 'scoring': result}
+	'''
+	results = dict()
+	for profile in sorted(app.config['SQLITE_PROFILES']):
+		with temporary_database(profile):
+			with app.app_context():
+				generate(users=users, matches=matches)
+			results[profile] = {
+				'idle': _read_while(readers, lambda: time.sleep(1)),
+				'scoring': _read_while(readers, lambda: _score(runs))
+			}
+	return results
+
+def _size(bets):
+	''' Users and matches for the number of bets, every user bets every match '''
+	users = max(1, int(math.sqrt(bets)))
+	return users, max(2, bets / users)
+
+def _login(email):
+	''' Test client with a generated user logged in '''
+	client = app.test_client()
+	csrf = app.config.get('WTF_CSRF_ENABLED', True)
+	app.config['WTF_CSRF_ENABLED'] = False
+	try:
+		client.post('/login', data={'email': email, 'password': PASSWORD})
+	finally:
+		app.config['WTF_CSRF_ENABLED'] = csrf
+	return client
+
+def _hot_paths(client, month, match_id):
+	'''
+	Hot paths as (name, prepare, run)
+	prepare runs before every timed run, it clears what run would reuse
+	'''
+	def get(url):
+		def run():
+			response = client.get(url)
+			assert response.status_code == 200, (url, response.status_code)
+		return run
+	return [
+		('check_points', _unscore, database.check_points),
+		('get_ranking', database.clear_caches, database.get_ranking),
+		('get_user_bets_with_points', None, lambda: database.get_user_bets_with_points(1, limit=51)),
+		('generate_calendar', database.clear_caches, lambda: common.generate_calendar(month.year, month.month)),
+		('single_match', database.clear_caches, get('/matches/match/{}'.format(match_id)))
+	]
+
+def _measure(prepare, run, repeat):
+	'''
+	Time run repeat times in new application contexts
+	Return the fastest and the median time and the queries of one run
+	'''
+	times = list()
+	queries = [0]
+	def count(*args):
+		queries[0] += 1
+	engines = set([db.engine, db.get_read_engine()])
+	for i in range(repeat):
+		# A new application context, versions read once per request are read again
+		with app.app_context(), app.test_request_context():
+			if prepare:
+				prepare()
+		db.session.remove()
+		queries[0] = 0
+		with app.app_context(), app.test_request_context():
+			for engine in engines:
+				event.listen(engine, 'before_cursor_execute', count)
+			try:
+				start = time.time()
+				run()
+				times.append(time.time() - start)
+			finally:
+				for engine in engines:
+					event.remove(engine, 'before_cursor_execute', count)
+		db.session.remove()
+	times.sort()
+	return times[0], times[len(times) / 2], queries[0]
+
+# Pages whose number of queries must not grow with the data
+PAGES = (
+	'/matches/2016/9',
+	'/matches/list',
+	'/matches/match/1',
+	'/ranking',
+	'/mypage',
+	'/mypage/bets'
+)
+
+def page_query_counts(sizes=(50, 2500)):
+	'''
+	Count the queries of every page on generated databases of the given sizes
+	Played matches are scored before counting
+	Return dictionary of page: list of query counts, one per size
+	'''
+	counts = dict((page, list()) for page in PAGES)
+	for bets in sizes:
+		users, matches = _size(bets)
+		with temporary_database():
+			with app.app_context():
+				generate(users=users, matches=matches, seed=bets)
+				database.check_points()
+			client = _login('user1@example.com')
+			for page in PAGES:
+				def run():
+					response = client.get(page)
+					assert response.status_code == 200, (page, response.status_code)
+				counts[page].append(_measure(database.clear_caches, run, 1)[2])
+	return counts
+
+def _commit():
+	''' Current git commit, None outside a git checkout '''
+	try:
+		return subprocess.check_output(
+			['git', 'rev-parse', 'HEAD'], cwd=app.root_path, stderr=subprocess.STDOUT
+		).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run_suite(sizes=(100, 10000, 100000), repeat=3, output=None):
+	'''
+	Time every hot path on generated databases of the given numbers of bets
+	Results are saved as JSON to output if given
+	Return list of results as dictionaries
+	'''
+	results = list()
+	for bets in sizes:
+		users, matches = _size(bets)
+		with temporary_database():
+			with app.app_context():
+				generate(users=users, matches=matches, seed=bets)
+				match = database.Match.query.order_by(database.Match.match_id).first()
+				month, match_id = match.match_time, match.match_id
+			client = _login('user1@example.com')
+			for name, prepare, run in _hot_paths(client, month, match_id):
+				best, median, queries = _measure(prepare, run, repeat)
+				results.append({
+					'path': name,
+					'bets': users * matches,
+					'users': users,
+					'matches': matches,
+					'best': best,
+					'median': median,
+					'queries': queries
+				})
+	if output:
+		with open(output, 'w') as f:
+			json.dump({
+				'commit': _commit(),
+				'created': common.timestamp().strftime('%Y-%m-%dT%H:%M:%S'),
+				'repeat': repeat,
+				'results': results
+			}, f, indent=1, sort_keys=True)
+	return results
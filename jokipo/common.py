@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import datetime
 import calendar
+import re
+import threading
 import xml.etree.ElementTree as etree
 import database
 
@@ -50,12 +52,91 @@ def set_timestamp(string_date):
 	'''
 	return datetime.datetime.strptime(string_date, "%d.%m.%Y %H:%M:%S")
 
-class Points():
-	''' For calculating the points '''
-	GOAL = 1
-	WIN = 1
-	TIE = 2
-	CORRECT = 1
+class RuleSet(object):
+	'''
+	One version of the scoring rules
+	Points of a bet depend only on the match result and the bet
+	'''
+	def __init__(self, version, goal, win, tie, correct):
+		self.version = version
+		self.goal = goal
+		self.win = win
+		self.tie = tie
+		self.correct = correct
+
+	def score(self, home_goals, away_goals, overtime, bet_home, bet_away):
+		''' Return points of one bet as (goals, wins, ties, corrects, total) '''
+		if overtime:
+			match_home = home_goals
+			match_away = away_goals
+		else:
+			match_home = min(home_goals, away_goals)
+			match_away = min(home_goals, away_goals)
+		# Which team won, positive = home, negative = away, 0 = tie
+		win_match = match_home - match_away
+		win_bet = bet_home - bet_away
+		goal_home = bet_home == match_home
+		goal_away = bet_away == match_away
+
+		goals = self.goal * (goal_home + goal_away)
+		wins = self.win if win_bet * win_match > 0 else 0
+		ties = self.tie if win_bet == 0 and win_match == 0 else 0
+		corrects = self.correct if goal_home and goal_away else 0
+		return goals, wins, ties, corrects, goals + wins + ties + corrects
+
+# Every rule set ever used, never change one which has scored points
+# New rules get a new version, taken in use with the rescore command
+RULE_SETS = {
+	1: RuleSet(1, goal=1, win=1, tie=2, correct=1)
+}
+
+def encode_cursor(dt, row_id):
+	''' Return pagination cursor for a row ordered by time and id '''
+	return '{}-{}'.format(dt.strftime('%Y%m%d%H%M%S'), row_id)
+
+def decode_cursor(cursor):
+	'''
+	Return cursor as (datetime, id)
+	None if there is no cursor or it is not valid
+	'''
+	try:
+		dt, row_id = cursor.split('-')
+		return datetime.datetime.strptime(dt, '%Y%m%d%H%M%S'), int(row_id)
+	except (AttributeError, ValueError):
+		return None
+
+class VersionedCache(object):
+	'''
+	Dictionary cache for data which changes only with a version counter
+	All entries are evicted when a newer version is seen
+	'''
+	def __init__(self):
+		self._version = None
+		self._items = dict()
+		self._lock = threading.Lock()
+
+	def _check(self, version):
+		if version != self._version:
+			self._items = dict()
+			self._version = version
+
+	def get(self, version, key):
+		''' Return cached value or None '''
+		with self._lock:
+			self._check(version)
+			return self._items.get(key)
+
+	def set(self, version, key, value):
+		''' Store value for the given version '''
+		with self._lock:
+			self._check(version)
+			self._items[key] = value
+
+	def clear(self):
+		''' Evict all entries '''
+		with self._lock:
+			self._version = None
+			self._items = dict()
 
 class MainMenuID():
 	''' Identify every main menu item '''
@@ -101,66 +182,98 @@ def calendar_header(root, year, month):
 		break
 	return root
 
+def first_of_next_month(dt):
+	''' Return the first day of the month after dt '''
+	if dt.month == 12:
+		return dt.replace(year=dt.year + 1, month=1, day=1)
+	return dt.replace(month=dt.month + 1, day=1)
+
 def calendar_days(root, year, month):
 	'''
 	Generate days for calendar
-	marks "today"
+	Day classes are left as markers, see day_class
+	Return root and base class of every day
 	'''
 	this_date = datetime.datetime.strptime(str(year) + '-' + str(month), '%Y-%m')
 	matches = database.get_matches_by_month(this_date)
 	matches_by_date = dict()
 	for match in matches:
-		try:
-			matches_by_date[match.match_time.day].append(match)
-		except:
-			matches_by_date[match.match_time.day] = list()
-			matches_by_date[match.match_time.day].append(match)
-	day_passed = True
-	cur_dt = timestamp()
+		matches_by_date.setdefault(match.match_time.day, list()).append(match)
+	day_classes = dict()
 	for elem in root.findall("*//td"):
 		_day = elem.text
 		elem.text = ''
-		try:
-			for day_match in matches_by_date[int(_day)]:
-				home_team = database.get_team(day_match.home_team_id).name[:3]
-				away_team = database.get_team(day_match.away_team_id).name[:3]
-				link = etree.SubElement(elem, "a")
-				link.tail = home_team + '-' + away_team
-				if day_match.played:
-					overtime = ' '
-					if day_match.overtime:
-						overtime += "JA" if day_match.overtime == 1 else "VL"
-					link.tail += ' ' + str(day_match.home_goals) + '-' + str(day_match.away_goals) + overtime
-				link.set('href', '/matches/match/' + str(day_match.match_id))
-				br = etree.SubElement(elem, 'br')
-				elem.set('class', elem.get('class') + ' match_day')
-		except:
-			pass
-		if _day != " ":
-			td_day_a = etree.SubElement(elem, 'a')
-			td_day_a.set('href', '#')#'/match_day/{}-{}-{}'.format(year, month, _day))
-			td_day = etree.SubElement(td_day_a, 'span')
-			td_day.tail = _day
-			td_day.set('class', 'day_number')
-		if year > cur_dt.year:
-			continue
-		if year == cur_dt.year and month > cur_dt.month:
+		if _day == " ":
 			continue
-		if _day == str(timestamp().day):
-			elem.set('class', elem.get('class') + ' today')
-			day_passed = False
-		if (month < cur_dt.month or day_passed or year < cur_dt.year) and elem.get('class') != 'noday':
-			elem.set('class', 'day_passed')
-	return root
+		day = int(_day)
+		for day_match in matches_by_date.get(day, list()):
+			home_team = database.get_team_info(day_match.home_team_id).abbreviation
+			away_team = database.get_team_info(day_match.away_team_id).abbreviation
+			link = etree.SubElement(elem, "a")
+			link.tail = home_team + '-' + away_team
+			# Live updates replace the score, see static/js/live.js
+			score = etree.SubElement(elem, 'span')
+			score.set('class', 'score')
+			score.set('data-match', str(day_match.match_id))
+			score.text = ''
+			if day_match.played:
+				overtime = ' '
+				if day_match.overtime:
+					overtime += "JA" if day_match.overtime == 1 else "VL"
+				score.text = ' ' + str(day_match.home_goals) + '-' + str(day_match.away_goals) + overtime
+			link.set('href', '/matches/match/' + str(day_match.match_id))
+			br = etree.SubElement(elem, 'br')
+			elem.set('class', elem.get('class') + ' match_day')
+		td_day_a = etree.SubElement(elem, 'a')
+		td_day_a.set('href', '#')#'/match_day/{}-{}-{}'.format(year, month, _day))
+		td_day = etree.SubElement(td_day_a, 'span')
+		td_day.tail = _day
+		td_day.set('class', 'day_number')
+		day_classes[day] = elem.get('class')
+		elem.set('class', 'day-class-{}'.format(day))
+	return root, day_classes
+
+def day_class(base, day, year, month, now):
+	'''
+	Return class for calendar day
+	marks "today" and the days already passed
+	'''
+	if (year, month) > (now.year, now.month):
+		return base
+	if (year, month) < (now.year, now.month) or day < now.day:
+		return 'day_passed'
+	if day == now.day:
+		return base + ' today'
+	return base
+
+_DAY_CLASS = re.compile(r'day-class-(\d+)')
+_calendar_cache = dict()
 
 def generate_calendar(year, month):
-	''' Generate calendar '''
-	myCal = calendar.HTMLCalendar(calendar.MONDAY)
-	htmlStr = myCal.formatmonth(year, month)
-	htmlStr = htmlStr.replace("&nbsp;"," ")
-	root = etree.fromstring(htmlStr)
-	# Generate header
-	root = calendar_header(root, year, month)
-	# Generate days
-	root = calendar_days(root, year, month)
-	return etree.tostring(root)
+	'''
+	Generate calendar
+	The month is rendered once per data version, only the
+	day classes are applied on every call
+	'''
+	version = (
+		database.get_version(database.month_version_name(year, month)),
+		database.get_version('teams')
+	)
+	cached = _calendar_cache.get((year, month))
+	if cached is None or cached[0] != version:
+		myCal = calendar.HTMLCalendar(calendar.MONDAY)
+		htmlStr = myCal.formatmonth(year, month)
+		htmlStr = htmlStr.replace("&nbsp;"," ")
+		root = etree.fromstring(htmlStr)
+		# Generate header
+		root = calendar_header(root, year, month)
+		# Generate days
+		root, day_classes = calendar_days(root, year, month)
+		cached = (version, etree.tostring(root, method='html'), day_classes)
+		_calendar_cache[(year, month)] = cached
+	version, html, day_classes = cached
+	now = timestamp()
+	return _DAY_CLASS.sub(
+		lambda m: day_class(day_classes[int(m.group(1))], int(m.group(1)), year, month, now),
+		html
+	)
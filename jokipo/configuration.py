@@ -8,7 +8,25 @@ print os.path.join(basedir, 'data.sqlite')
 
 app.config.update(
 	SECRET_KEY = 'Monthy Python and the Super Rabbit',
-	SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'data.sqlite'),
+	SQLALCHEMY_DATABASE_URI = os.environ.get(
+		'JOKIPO_DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+	),
+	# SQLite connection settings, None keeps the SQLite default
+	# pool_size is connections kept open per worker process, 0 opens one per use
+	SQLITE_PROFILE = os.environ.get('JOKIPO_SQLITE_PROFILE', 'production'),
+	SQLITE_PROFILES = {
+		'default': {},
+		'production': {
+			'journal_mode': 'WAL',
+			'synchronous': 'NORMAL',
+			# milliseconds
+			'busy_timeout': 5000,
+			# negative is KiB
+			'cache_size': -16000,
+			'mmap_size': 64 * 1024 * 1024,
+			'pool_size': 5
+		}
+	},
 	SQLALCHEMY_COMMIT_ON_TEARDOWN = False,
 	SQLALCHEMY_TRACK_MODIFICATIONS = True,
 	MAIL_SERVER = 'smtp.gmail.com',
@@ -18,5 +36,46 @@ app.config.update(
 	MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD'),
 	FLASKY_MAIL_SUBJECT_PREFIX = 'JOKIPO VEIKKAUS: ',
 	FLASKY_MAIL_SENDER = 'Jokipoveikkaus <jokikoveikkaus@gmail.com>',
-	FLASKY_ADMIN = 'flask@admin.user'
+	FLASKY_ADMIN = 'flask@admin.user',
+	# Followed (statgroupid, teamid) pairs of tilastopalvelu, one per team and season
+	MESTIS_TARGETS = [(168, 425114685)],
+	MESTIS_WORKERS = 4,
+	MESTIS_TIMEOUT = 30,
+	# Downloaded feed pages are kept here between restarts
+	FEED_CACHE_DIR = os.path.join(basedir, 'feed_cache'),
+	# Seconds a downloaded feed page is used without asking the server
+	FEED_MAX_AGE = 30,
+	# Background result polling, seconds
+	RESULT_POLLER = False,
+	POLL_FAST = 60,
+	POLL_SLOW = 6 * 3600,
+	# Match counts as live this long after its start time
+	POLL_LIVE = 4 * 3600,
+	SYNC_LOCK_FILE = os.path.join(basedir, 'sync.lock'),
+	# Poller status shared with the web processes
+	POLL_STATUS_FILE = os.path.join(basedir, 'poller.json'),
+	# Live score updates, every open page holds a worker thread while
+	# connected so keep off with a small number of threaded workers
+	LIVE_EVENTS = False,
+	# Live event streams served at once by one process
+	MAX_EVENT_CLIENTS = 20,
+	# Password hashing, 0 processes hashes in the request thread
+	BCRYPT_ROUNDS = 12,
+	BCRYPT_POOL_SIZE = 2,
+	BCRYPT_TIMEOUT = 30,
+	# Seconds a logged in user is identified without SQL
+	USER_CACHE_TTL = 60,
+	# Outgoing mail waiting at most, and sent at most at once
+	MAIL_QUEUE_SIZE = 500,
+	MAIL_BATCH_SIZE = 20,
+	# Version of common.RULE_SETS used until a rescore picks another one
+	SCORING_RULES = 1,
+	# Requests slower than this many seconds are logged, None logs nothing
+	SLOW_REQUEST_THRESHOLD = 1.0,
+	# Statements logged with a slow request, slowest first
+	SLOW_REQUEST_STATEMENTS = 5,
+	# Addresses allowed to read /metrics
+	# Behind a reverse proxy on the same host every request comes from
+	# 127.0.0.1, so /metrics is public unless the proxy blocks it
+	METRICS_ALLOWED_IPS = ['127.0.0.1']
 )
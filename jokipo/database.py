@@ -1,16 +1,105 @@
 # -*- coding: utf-8 -*-
 import datetime
-import bcrypt
+import time
+import collections
+import threading
+import passwords
 import common
 import gameloader
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
+import events
+import sqlite3
+import sqlalchemy
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import or_, and_, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import joinedload, configure_mappers, scoped_session, Session
+from sqlalchemy.sql.expression import Join
+from sqlalchemy.ext.compiler import compiles
 from flask.ext.login import UserMixin
 from main import app, login_manager
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import current_app
+from flask import current_app, g, has_app_context
 
-db = SQLAlchemy(app)
+# Pragmas set on every new SQLite connection from the selected profile
+SQLITE_PRAGMAS = ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size')
+
+# Bets and standings are upserted with ON CONFLICT, new in SQLite 3.24
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') and sqlite3.sqlite_version_info < (3, 24, 0):
+	raise RuntimeError('SQLite 3.24 or newer is needed, this is {}'.format(sqlite3.sqlite_version))
+
+def get_sqlite_profile(config=None):
+	''' Settings of the selected SQLite engine profile '''
+	config = config or app.config
+	return config['SQLITE_PROFILES'][config['SQLITE_PROFILE']]
+
+def _is_sqlite_file(url):
+	return url.drivername == 'sqlite' and url.database not in (None, '', ':memory:')
+
+class PooledSQLAlchemy(SQLAlchemy):
+	'''
+	SQLAlchemy keeping a pool of SQLite connections in every worker process
+	A second engine serves the read session, its connections never write
+	'''
+	def __init__(self, *args, **kwargs):
+		self._read_engine = (None, None)
+		self._read_lock = threading.Lock()
+		SQLAlchemy.__init__(self, *args, **kwargs)
+
+	def apply_driver_hacks(self, app, info, options):
+		SQLAlchemy.apply_driver_hacks(self, app, info, options)
+		pool_size = get_sqlite_profile(app.config).get('pool_size')
+		if _is_sqlite_file(info) and pool_size:
+			options['poolclass'] = QueuePool
+			options['pool_size'] = pool_size
+			options.setdefault('connect_args', {})['check_same_thread'] = False
+
+	def get_read_engine(self):
+		'''
+		Engine for read only queries
+		In memory and other than SQLite databases share the main engine
+		'''
+		engine = self.engine
+		if not _is_sqlite_file(engine.url):
+			return engine
+		with self._read_lock:
+			if self._read_engine[0] is not engine:
+				if self._read_engine[1] is not None:
+					self._read_engine[1].dispose()
+				options = {'convert_unicode': True}
+				self.apply_pool_defaults(app, options)
+				self.apply_driver_hacks(app, sqlalchemy.engine.url.make_url(engine.url), options)
+				read_engine = sqlalchemy.create_engine(engine.url, **options)
+				event.listen(read_engine, 'connect', _set_query_only)
+				self._read_engine = (engine, read_engine)
+			return self._read_engine[1]
+
+@event.listens_for(Engine, 'connect')
+def _set_pragmas(dbapi_connection, connection_record):
+	if not isinstance(dbapi_connection, sqlite3.Connection):
+		return
+	profile = get_sqlite_profile()
+	cursor = dbapi_connection.cursor()
+	for pragma in SQLITE_PRAGMAS:
+		if profile.get(pragma) is not None:
+			cursor.execute('PRAGMA {} = {}'.format(pragma, profile[pragma]))
+	cursor.close()
+
+def _set_query_only(dbapi_connection, connection_record):
+	dbapi_connection.execute('PRAGMA query_only = 1')
+
+db = PooledSQLAlchemy(app)
+
+# Session for pages which only read, such as ranking and calendar
+# In WAL mode its queries never wait for a writer
+read_session = scoped_session(lambda: Session(bind=db.get_read_engine(), autoflush=False))
+
+@app.teardown_appcontext
+def _remove_read_session(exception):
+	read_session.remove()
+
+gameloader.GameLoader.cache.directory = app.config['FEED_CACHE_DIR']
+gameloader.GameLoader.cache.max_age = app.config['FEED_MAX_AGE']
 
 # Database models and tables
 
@@ -30,7 +119,7 @@ class User(UserMixin, db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	username = db.Column(db.String(64), unique=True, nullable=False, index=True)
 	password = db.Column(db.String(128), nullable=False)
-	email = db.Column(db.String(64), nullable=False)
+	email = db.Column(db.String(64), nullable=False, index=True)
 	date_registered = db.Column(db.DateTime)
 	date_login = db.Column(db.DateTime)
 	role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
@@ -55,15 +144,10 @@ class User(UserMixin, db.Model):
 		return True
 	
 	def set_password(self, pw):
-		pwhash = bcrypt.hashpw(pw.encode('utf8'), bcrypt.gensalt())
-		self.password = pwhash
+		self.password = passwords.hash_password(pw)
 
 	def check_password(self, pw):
-		if self.password is not None:
-			expected_hash = self.password
-			actual_hash = bcrypt.hashpw(pw.encode('utf8'), expected_hash.encode('utf8'))
-			return expected_hash == actual_hash
-		return False
+		return passwords.check_password(pw, self.password)
 	
 	def __repr__(self):
 		return '<User {}>'.format(self.username)
@@ -83,8 +167,8 @@ class Match(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	match_id = db.Column(db.Integer, unique=True)
 	match_time = db.Column(db.DateTime)
-	home_team_id = db.Column(db.Integer, db.ForeignKey('teams.team_id'))
-	away_team_id = db.Column(db.Integer, db.ForeignKey('teams.team_id'))
+	home_team_id = db.Column(db.Integer, db.ForeignKey('teams.team_id'), index=True)
+	away_team_id = db.Column(db.Integer, db.ForeignKey('teams.team_id'), index=True)
 	home_goals = db.Column(db.Integer, default=0)
 	away_goals = db.Column(db.Integer, default=0)
 	overtime = db.Column(db.Integer, default=0)
@@ -94,6 +178,13 @@ class Match(db.Model):
 	home_team = db.relationship("Team", foreign_keys=home_team_id)
 	away_team = db.relationship("Team", foreign_keys=away_team_id)
 
+	__table_args__ = (
+		# Finished matches waiting for scoring
+		db.Index('ix_matches_played_shared', 'played', 'points_shared'),
+		# Calendar order, pages of bets walk this instead of sorting
+		db.Index('ix_matches_time_match', 'match_time', 'match_id'),
+	)
+
 class Bet(db.Model):
 	''' Bet table '''
 	__tablename__ = 'bets'
@@ -106,6 +197,12 @@ class Bet(db.Model):
 	user = db.relationship("User", foreign_keys=user_id)
 	match = db.relationship("Match", foreign_keys=match_id)
 
+	__table_args__ = (
+		# One bet per user and match, target of the upsert in add_bet
+		db.Index('uq_bets_user_match', 'user_id', 'match_id', unique=True),
+		db.Index('ix_bets_match_user', 'match_id', 'user_id'),
+	)
+
 class Points(db.Model):
 	''' Table for storing all the points users has got '''
 	__tablename__ = 'points'
@@ -118,11 +215,166 @@ class Points(db.Model):
 	corrects = db.Column(db.Integer)
 	total = db.Column(db.Integer)
 
+	__table_args__ = (
+		db.Index('ix_points_user_match', 'user_id', 'match_id'),
+	)
+
+class Standing(db.Model):
+	''' Ranking table, one row of summed points per user '''
+	__tablename__ = 'standings'
+	id = db.Column(db.Integer, primary_key=True)
+	user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True)
+	goals = db.Column(db.Integer, default=0)
+	wins = db.Column(db.Integer, default=0)
+	ties = db.Column(db.Integer, default=0)
+	corrects = db.Column(db.Integer, default=0)
+	total = db.Column(db.Integer, default=0)
+	bets = db.Column(db.Integer, default=0)
+
+	user = db.relationship("User", foreign_keys=user_id)
+
+	__table_args__ = (
+		# Same order as the tie-breaks of the ranking
+		db.Index(
+			'ix_standings_ranking',
+			'total', 'corrects', 'ties', 'wins', 'goals'
+		),
+	)
+
+class Version(db.Model):
+	''' Counters which go up every time the related data changes '''
+	__tablename__ = 'versions'
+	name = db.Column(db.String(64), primary_key=True)
+	value = db.Column(db.Integer, default=0, nullable=False)
+
 # Functions to retrieve or add data
 
+def get_version(name):
+	'''
+	Get current value of a data version counter
+	Read only once per request
+	'''
+	versions = None
+	if has_app_context():
+		versions = getattr(g, '_versions', None)
+		if versions is None:
+			versions = g._versions = dict()
+		if name in versions:
+			return versions[name]
+	version = read_session.query(Version.value).filter_by(name=name).scalar() or 0
+	if versions is not None:
+		versions[name] = version
+	return version
+
+def bump_version(name):
+	'''
+	Increase a data version counter
+	Does not commit, the caller owns the transaction
+	'''
+	updated = Version.query.filter_by(name=name).update(
+		{'value': Version.value + 1}, synchronize_session=False
+	)
+	if not updated:
+		db.session.add(Version(name=name, value=1))
+	if has_app_context():
+		getattr(g, '_versions', dict()).pop(name, None)
+
+def set_version(name, value):
+	'''
+	Set a data version counter, e.g. the active rule set
+	Does not commit, the caller owns the transaction
+	'''
+	db.session.merge(Version(name=name, value=value))
+	if has_app_context():
+		getattr(g, '_versions', dict()).pop(name, None)
+
+RoleInfo = collections.namedtuple('RoleInfo', 'id name')
+
+class SessionUser(UserMixin):
+	'''
+	Copy of User for identifying the logged in user without SQL
+	Use get_user_by_id for changing the user
+	'''
+	def __init__(self, user):
+		self.id = user.id
+		self.username = user.username
+		self.email = user.email
+		self.role_id = user.role_id
+		self.role = RoleInfo(user.role.id, user.role.name) if user.role else None
+		self.confirmed = user.confirmed
+		self.disabled = user.disabled
+		self.date_registered = user.date_registered
+
+	def check_password(self, pw):
+		return get_user_by_id(self.id).check_password(pw)
+
+	def __repr__(self):
+		return '<SessionUser {}>'.format(self.username)
+
+_user_cache = dict()
+_user_cache_lock = threading.Lock()
+_user_cache_stats = {'hits': 0, 'misses': 0}
+# Users changed in transactions which are not committed yet
+_users_changed = set()
+
 @login_manager.user_loader
 def load_user(user_id):
-	''' Get User from database '''
+	'''
+	Get logged in user
+	Cached for USER_CACHE_TTL seconds, changes to password, role,
+	confirmation or disabled flag evict the user
+	'''
+	user_id = int(user_id)
+	now = time.time()
+	cached = _user_cache.get(user_id)
+	if cached is not None and cached[0] > now:
+		_user_cache_stats['hits'] += 1
+		return cached[1]
+	_user_cache_stats['misses'] += 1
+	user = User.query.options(joinedload(User.role)).get(user_id)
+	if user is None:
+		return None
+	session_user = SessionUser(user)
+	with _user_cache_lock:
+		_user_cache[user_id] = (now + app.config['USER_CACHE_TTL'], session_user)
+	return session_user
+
+def invalidate_user(user_id):
+	''' Remove user from the session user cache '''
+	with _user_cache_lock:
+		_user_cache.pop(user_id, None)
+
+def get_user_cache_stats():
+	''' Session user cache counters for monitoring '''
+	hits = _user_cache_stats['hits']
+	misses = _user_cache_stats['misses']
+	return {
+		'hits': hits,
+		'misses': misses,
+		'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.0,
+		'size': len(_user_cache)
+	}
+
+def _user_changed(target, value, oldvalue, initiator):
+	if target.id is not None:
+		invalidate_user(target.id)
+		_users_changed.add(target.id)
+
+# Role backref exists only after the mappers are configured
+configure_mappers()
+for _attribute in (User.password, User.role_id, User.role, User.confirmed, User.disabled):
+	event.listen(_attribute, 'set', _user_changed)
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _users_committed(session):
+	''' Evict again after commit, a request may have cached the old values '''
+	while _users_changed:
+		invalidate_user(_users_changed.pop())
+
+def get_user_by_id(user_id):
+	'''
+	Find user from SQL using id
+	'''
 	return User.query.get(int(user_id))
 
 def get_role(role):
@@ -174,6 +426,9 @@ def validate_user(email, password):
 	user = get_user_by_email(email)
 	print user
 	if user and user.check_password(password):
+		# Hashes made with an older cost factor are upgraded
+		if passwords.needs_rehash(user.password):
+			user.set_password(password)
 		# Update the last login timestamp
 		user.date_login = common.timestamp()
 		db.session.add(user)
@@ -190,30 +445,91 @@ def get_team(team_id):
 	Get team by team id
 	'''
 	return Team.query.filter_by(team_id=team_id).first()
+
+TeamInfo = collections.namedtuple('TeamInfo', 'team_id name abbreviation logo')
+_team_cache = common.VersionedCache()
+
+def get_team_registry():
+	'''
+	Return all teams as TeamInfo keyed by team id
+	Reloaded only when teams are added or renamed
+	'''
+	version = get_version('teams')
+	teams = _team_cache.get(version, 'teams')
+	if teams is None:
+		teams = {
+			team.team_id: TeamInfo(team.team_id, team.name, team.name[:3], team.logo)
+			for team in read_session.query(Team)
+		}
+		_team_cache.set(version, 'teams', teams)
+	return teams
+
+def get_team_info(team_id):
+	''' Get TeamInfo by team id without querying SQL '''
+	return get_team_registry().get(int(team_id))
 	
-def get_matches(played=None):
+def _matches_query(eager=False, session=None):
+	'''
+	Base query for matches
+	With eager, home and away teams are joined in the same query
+	'''
+	query = (session or db.session).query(Match)
+	if eager:
+		query = query.options(
+			joinedload(Match.home_team),
+			joinedload(Match.away_team)
+		)
+	return query
+
+def get_matches(played=None, eager=False):
 	''' Get played, not played or all matches '''
+	query = _matches_query(eager).order_by(Match.match_time)
 	if played is 1:
-		return Match.query.order_by('match_time').filter_by(played=1).all()
+		return query.filter_by(played=1).all()
 	elif played is 0:
-		return Match.query.order_by('match_time').filter_by(played=0).all()
+		return query.filter_by(played=0).all()
 	else:
-		return Match.query.order_by('match_time').all()
+		return query.all()
 
-def get_matches_by_team(team_id):
+def get_matches_by_team(team_id, eager=False):
 	''' Return all team matches as list '''
-	return db.session.query(Match).order_by('match_time').filter(or_(
+	return _matches_query(eager).order_by(Match.match_time).filter(or_(
 		Match.home_team_id == team_id,
 		Match.away_team_id == team_id
 	)).all()
 		
-def get_matches_by_month(dt):
+def get_matches_by_month(dt, eager=False):
 	'''
 	Get all the matches from the selected month
 	'''
-	start = str(dt)
-	end = str(common.add_one_month(dt))
-	return db.session.query(Match).filter(Match.match_time.between(start, end)).all()
+	start = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+	end = common.first_of_next_month(start)
+	return _matches_query(eager, read_session).filter(
+		Match.match_time >= start,
+		Match.match_time < end
+	).all()
+
+def month_version_name(year, month):
+	''' Name of the version counter for matches of one month '''
+	return 'calendar:{}-{:02d}'.format(year, month)
+
+def bump_match_months(match_times):
+	'''
+	Increase version of every month having changed matches
+	Does not commit, the caller owns the transaction
+	'''
+	for year, month in set((dt.year, dt.month) for dt in match_times if dt):
+		bump_version(month_version_name(year, month))
+	
+def count_matches_between(start, end):
+	''' Number of matches starting between start and end '''
+	return Match.query.filter(Match.match_time.between(start, end)).count()
+
+def get_next_match_time(dt):
+	''' Start time of the next match after dt, None if there is none '''
+	return db.session.query(db.func.min(Match.match_time)).filter(
+		Match.match_time > dt
+	).scalar()
 	
 def get_match(match_id):
 	''' Get Match details '''
@@ -223,141 +539,473 @@ def get_bet(match_id, user_id):
 	''' Get users bet for single match '''
 	return Bet.query.filter_by(match_id=match_id, user_id=user_id).first()
 	
-def get_all_bets(match_id):
-	''' Get all bets according to the match id '''
-	return Bet.query.filter_by(match_id=match_id).all()
+def get_all_bets(match_id, eager=False):
+	'''
+	Get all bets according to the match id
+	With eager, users are joined in the same query
+	'''
+	query = Bet.query.filter_by(match_id=match_id)
+	if eager:
+		query = query.options(joinedload(Bet.user))
+	return query.all()
 
 def get_user_bets_all(user_id):
 	''' Get all bets that user has been done so far '''
 	return db.session.query(Bet, Match).filter_by(user_id=user_id).join(Match).order_by(Match.match_time).all()
 	
-def get_user_bets_with_points(user_id):
-	''' Get all bets of user, including points '''
-	all = get_user_bets_all(user_id)
-	_return = list()
-	for single in all:
-		points = db.session.query(Points.total).filter_by(user_id=user_id, match_id=single.Match.id).first()
-		if points:
-			_s = [single[0], single[1], points[0]]
-		else:
-			_s = [single[0], single[1], 0]
-		_return.append(_s)
-	return _return
+class CrossJoin(Join):
+	''' Inner join which SQLite runs in the written order, left table first '''
+
+@compiles(CrossJoin)
+def _compile_cross_join(join, compiler, asfrom=False, **kwargs):
+	return '{} CROSS JOIN {} ON {}'.format(
+		join.left._compiler_dispatch(compiler, asfrom=True, **kwargs),
+		join.right._compiler_dispatch(compiler, asfrom=True, **kwargs),
+		join.onclause._compiler_dispatch(compiler, **kwargs)
+	)
+
+def _user_bets_query(user_id):
+	'''
+	Bets of user joined with the match and the points of the bet
+	Matches are walked in calendar order and the bet of the user looked
+	up for each, so a page never sorts all bets of the user
+	'''
+	return db.session.query(
+		Bet, Match, db.func.coalesce(Points.total, 0)
+	).select_from(
+		CrossJoin(Match.__table__, Bet.__table__, and_(
+			Bet.match_id == Match.match_id,
+			Bet.user_id == user_id
+		)).outerjoin(Points.__table__, and_(
+			Points.match_id == Bet.match_id,
+			Points.user_id == Bet.user_id
+		))
+	).order_by(Match.match_time, Match.match_id)
+
+def get_user_bets_with_points(user_id, after=None, limit=None):
+	'''
+	Get bets of user, including points
+
+	Keyword arguments:
+	user_id	-- id of the user
+	after	-- (match_time, match_id) of the last bet on the previous page
+	limit	-- maximum number of bets to return
+	'''
+	query = _user_bets_query(user_id)
+	if after:
+		match_time, match_id = after
+		# The first condition is the start of the index range
+		query = query.filter(Match.match_time >= match_time, or_(
+			Match.match_time > match_time,
+			and_(Match.match_time == match_time, Match.match_id > match_id)
+		))
+	if limit:
+		query = query.limit(limit)
+	return [list(row) for row in query]
+
+def iter_user_bets_with_points(user_id, chunk=500):
+	'''
+	Stream all bets of user, including points
+	Rows are fetched in chunks, for exports
+	'''
+	return _user_bets_query(user_id).yield_per(chunk)
 	
+_upsert_bet = db.text(
+	'INSERT INTO bets (user_id, match_id, home_goals, away_goals) '
+	'VALUES (:user_id, :match_id, :home_goals, :away_goals) '
+	'ON CONFLICT (user_id, match_id) DO UPDATE SET '
+	'home_goals = excluded.home_goals, away_goals = excluded.away_goals'
+)
+
+def upsert_bets(rows):
+	'''
+	Insert or update bets in a single statement
+	Does not commit, the caller owns the transaction
+
+	Keyword arguments:
+	rows	-- bets as dictionaries of user_id, match_id, home_goals, away_goals
+	'''
+	if rows:
+		db.session.execute(_upsert_bet, rows)
+
 def add_bet(match_id, user_id, home_goals, away_goals):
-	''' Adding new bet '''
-	old_bet = get_bet(match_id, user_id)
-	if old_bet:
-		old_bet.home_goals = home_goals
-		old_bet.away_goals = away_goals
-		new_bet = old_bet
-	else:
-		new_bet = Bet(
-			match_id = match_id,
-			user_id = user_id,
-			home_goals = home_goals,
-			away_goals = away_goals
-		)
-	db.session.add(new_bet)
+	''' Adding new bet or updating the old one '''
+	upsert_bets([{
+		'match_id': match_id,
+		'user_id': user_id,
+		'home_goals': home_goals,
+		'away_goals': away_goals
+	}])
+	db.session.commit()
+
+def get_user_bets_by_match(user_id, match_ids):
+	''' Bets of user for the given matches keyed by match id '''
+	if not match_ids:
+		return dict()
+	return {
+		bet.match_id: bet
+		for bet in Bet.query.filter(Bet.user_id == user_id, Bet.match_id.in_(match_ids))
+	}
+
+def add_bets(user_id, bets, now=None):
+	'''
+	Add or update many bets of user in one transaction
+	Bets for matches which have already started are rejected
+
+	Keyword arguments:
+	user_id	-- id of the betting user
+	bets	-- list of (match_id, home_goals, away_goals)
+	now		-- current time, default is common.timestamp()
+	
+	Return dictionary of match id: None if accepted, else reason
+	'''
+	if now is None:
+		now = common.timestamp()
+	match_ids = [match_id for match_id, home_goals, away_goals in bets]
+	if not match_ids:
+		return dict()
+	start_times = dict(db.session.query(Match.match_id, Match.match_time).filter(
+		Match.match_id.in_(match_ids)
+	))
+	rows = list()
+	status = dict()
+	for match_id, home_goals, away_goals in bets:
+		if match_id not in start_times:
+			status[match_id] = 'unknown match'
+		elif now >= start_times[match_id]:
+			status[match_id] = 'match started'
+		elif home_goals < 0 or away_goals < 0:
+			status[match_id] = 'invalid goals'
+		else:
+			rows.append({
+				'match_id': match_id,
+				'user_id': user_id,
+				'home_goals': home_goals,
+				'away_goals': away_goals
+			})
+			status[match_id] = None
+	upsert_bets(rows)
 	db.session.commit()
+	return status
 
 def get_points(match_id, user_id):
 	''' Get points that user has got in single match '''
 	return Points.query.filter_by(match_id=match_id, user_id=user_id).first()
 
-def check_points():
+def get_rule_set():
+	'''
+	Scoring rules the stored points are made with
+	The configured rules are used until a rescore records its own
+	'''
+	return common.RULE_SETS[get_version('rules') or app.config['SCORING_RULES']]
+
+def score_bets(match, bets, rules=None):
+	'''
+	Score all bets of one match together
+
+	Keyword arguments:
+	match	-- played Match
+	bets	-- rows of (user_id, home_goals, away_goals)
+	rules	-- RuleSet, default is get_rule_set()
+	'''
+	if not bets:
+		return list()
+	rules = rules or get_rule_set()
+	rows = list()
+	for user_id, home_goals, away_goals in bets:
+		goals, wins, ties, corrects, total = rules.score(
+			match.home_goals, match.away_goals, match.overtime, home_goals, away_goals
+		)
+		rows.append({
+			'match_id': match.match_id,
+			'user_id': user_id,
+			'goals': goals,
+			'wins': wins,
+			'ties': ties,
+			'corrects': corrects,
+			'total': total
+		})
+	return rows
+
+def check_points(match_ids=None):
 	'''
 	Check what user has bet and what was the result of the game
-	Write points to SQL
-	'''
-	matches = Match.query.order_by('match_time').filter_by(played=1, points_shared=0).all()
-	print matches
-	for match in matches:
-		print match
-		for bet in get_all_bets(match.match_id):
-			if get_points(match.match_id, bet.user_id):
-				continue
-			if match.overtime:
-				match_home_goals = match.home_goals
-				match_away_goals = match.away_goals
-			else:
-				match_home_goals = min(match.home_goals, match.away_goals)
-				match_away_goals = min(match.home_goals, match.away_goals)
-				
-			# Bet home goals is the same as match home goals
-			goal_home = bet.home_goals == match_home_goals
-			# Bet away goals is the same as match away goals
-			goal_away = bet.away_goals == match_away_goals
-			# Bet is tie
-			tie_bet = (bet.home_goals - bet.away_goals) == 0
-			# Match is tie
-			tie_match = (match_home_goals - match_away_goals) == 0
-			# Which team won the game, positive = home, negative = away, 0 = tie
-			win_bet = (bet.home_goals - bet.away_goals)
-			win_match = (match_home_goals - match_away_goals)
-			
-			goal = 0
-			win = 0
-			tie = 0
-			correct = 0
-			if goal_home:
-				goal += common.Points.GOAL
-			if goal_away:
-				goal += common.Points.GOAL
-			if tie_bet and tie_match:
-				tie += common.Points.TIE
-			elif (win_bet > 0 and win_match > 0) or (win_bet < 0 and win_match < 0):
-				win += common.Points.WIN
-			if goal_home and goal_away:
-				correct += common.Points.CORRECT
-			total = goal + tie + win + correct
-			
-			db.session.add(Points(
-				match_id=match_id,
-				user_id=bet.user_id,
-				goals=goal,
-				wins=win,
-				ties=tie,
-				corrects=correct,
-				total=total
-			))
-			match.points_shared = 1
-			db.session.add(match)
-			db.session.commit()
+	Write points to SQL in a single transaction
+	Return the number of scored bets
 
-def get_ranking():
-	''' Generate ranking list '''
+	Keyword arguments:
+	match_ids	-- score only these matches, default is all unscored matches
+	'''
+	start = time.time()
+	query = Match.query.filter_by(played=1, points_shared=0)
+	if match_ids is not None:
+		if not match_ids:
+			return 0
+		query = query.filter(Match.match_id.in_(match_ids))
+	matches = query.all()
+	if not matches:
+		return 0
+	matches = {match.match_id: match for match in matches}
+
+	# Every bet of the new matches which has not been scored yet
+	bets = db.session.query(
+		Bet.match_id, Bet.user_id, Bet.home_goals, Bet.away_goals
+	).outerjoin(Points, and_(
+		Points.match_id == Bet.match_id,
+		Points.user_id == Bet.user_id
+	)).filter(
+		Bet.match_id.in_(matches.keys()),
+		Points.id == None
+	).all()
+	bets_by_match = dict()
+	for match_id, user_id, home_goals, away_goals in bets:
+		bets_by_match.setdefault(match_id, list()).append(
+			(user_id, home_goals, away_goals)
+		)
+
+	rules = get_rule_set()
+	rows = list()
+	for match_id, match in matches.iteritems():
+		rows.extend(score_bets(match, bets_by_match.get(match_id), rules))
+
+	if rows:
+		db.session.bulk_insert_mappings(Points, rows)
+		update_standings(rows)
+		bump_version('scoring')
+	Match.query.filter(Match.match_id.in_(matches.keys())).update(
+		{'points_shared': 1}, synchronize_session=False
+	)
+	db.session.commit()
+	for match_id in matches:
+		events.broadcaster.publish('points', {
+			'match_id': match_id,
+			'bets': len(bets_by_match.get(match_id, ()))
+		})
+
+	elapsed = time.time() - start
+	app.logger.info(
+		'%d bets scored in %.3f s (%.0f bets/s)',
+		len(rows), elapsed, len(rows) / elapsed if elapsed else 0
+	)
+	return len(rows)
+
+_upsert_standing = db.text(
+	'INSERT INTO standings (user_id, goals, wins, ties, corrects, total, bets) '
+	'VALUES (:user_id, :goals, :wins, :ties, :corrects, :total, :bets) '
+	'ON CONFLICT (user_id) DO UPDATE SET '
+	'goals = goals + excluded.goals, wins = wins + excluded.wins, '
+	'ties = ties + excluded.ties, corrects = corrects + excluded.corrects, '
+	'total = total + excluded.total, bets = bets + excluded.bets'
+)
+
+def update_standings(rows):
+	'''
+	Add newly awarded points to the standings in one statement
+	Does not commit, the caller owns the transaction
+
+	Keyword arguments:
+	rows	-- Points rows as dictionaries
+	'''
+	added = dict()
+	for row in rows:
+		s = added.setdefault(row['user_id'], {
+			'goals': 0, 'wins': 0, 'ties': 0, 'corrects': 0, 'total': 0, 'bets': 0
+		})
+		for key in ('goals', 'wins', 'ties', 'corrects', 'total'):
+			s[key] += row[key]
+		s['bets'] += 1
+	db.session.execute(_upsert_standing, [
+		dict(s, user_id=user_id) for user_id, s in added.iteritems()
+	])
+
+def rebuild_standings():
+	'''
+	Recompute the whole standings table from points
+	Return the number of ranked users
+	'''
+	users = _rebuild_standings()
+	db.session.commit()
+	return users
+
+def _rebuild_standings():
+	'''
+	Recompute the whole standings table from points
+	Does not commit, the caller owns the transaction
+	'''
 	points = db.session.query(
 		Points.user_id,
-		db.func.sum(Points.goals).label('total_goals'),
-		db.func.sum(Points.wins).label('total_wins'),
-		db.func.sum(Points.ties).label('total_ties'),
-		db.func.sum(Points.corrects).label('total_corrects'),
-		db.func.sum(Points.total).label('total_total'),
-		db.func.count(Points.user_id).label('bets')
-	).order_by(
-		db.desc('total_total'),
-		db.desc('total_corrects'),
-		db.desc('total_ties'),
-		db.desc('total_wins'),
-		db.desc('total_goals')
-	).group_by('user_id').all()
-	ranking = dict()
-	nro = 1
-	for p in points:
-		user = User.query.filter_by(id=p[0]).first()
-		ranking[nro] = {
-			'user': user,
+		db.func.sum(Points.goals),
+		db.func.sum(Points.wins),
+		db.func.sum(Points.ties),
+		db.func.sum(Points.corrects),
+		db.func.sum(Points.total),
+		db.func.count(Points.user_id)
+	).group_by(Points.user_id).all()
+	Standing.query.delete()
+	db.session.bulk_insert_mappings(Standing, [
+		{
+			'user_id': p[0],
 			'goals': p[1],
 			'wins': p[2],
-			'ties': int(p[3]) / 2,
+			'ties': p[3],
 			'corrects': p[4],
 			'total': p[5],
 			'bets': p[6]
 		}
+		for p in points
+	])
+	bump_version('scoring')
+	return len(points)
+
+def rescore(version=None, chunk=5000):
+	'''
+	Score every bet of the scored matches again
+	New points are collected into a staging table chunk by chunk and
+	swapped in with the standings and the rule version in one transaction
+	Return the number of scored bets
+
+	Keyword arguments:
+	version	-- version of the rule set, default is the current one
+	chunk	-- bets scored and written at once
+	'''
+	rules = common.RULE_SETS[version] if version else get_rule_set()
+	db.session.execute('DROP TABLE IF EXISTS points_rescore')
+	db.session.execute(
+		'CREATE TABLE points_rescore (user_id INTEGER, match_id INTEGER, goals INTEGER, '
+		'wins INTEGER, ties INTEGER, corrects INTEGER, total INTEGER)'
+	)
+	db.session.commit()
+	insert = db.text(
+		'INSERT INTO points_rescore (user_id, match_id, goals, wins, ties, corrects, total) '
+		'VALUES (:user_id, :match_id, :goals, :wins, :ties, :corrects, :total)'
+	)
+	scored = 0
+	last_id = 0
+	try:
+		while True:
+			bets = db.session.query(
+				Bet.id, Bet.user_id, Bet.match_id, Bet.home_goals, Bet.away_goals,
+				Match.home_goals, Match.away_goals, Match.overtime
+			).join(Match, Bet.match_id == Match.match_id).filter(
+				Match.points_shared == 1,
+				Bet.id > last_id
+			).order_by(Bet.id).limit(chunk).all()
+			if not bets:
+				break
+			rows = list()
+			for bet_id, user_id, match_id, bet_home, bet_away, home, away, overtime in bets:
+				goals, wins, ties, corrects, total = rules.score(home, away, overtime, bet_home, bet_away)
+				rows.append({
+					'user_id': user_id,
+					'match_id': match_id,
+					'goals': goals,
+					'wins': wins,
+					'ties': ties,
+					'corrects': corrects,
+					'total': total
+				})
+			db.session.execute(insert, rows)
+			db.session.commit()
+			scored += len(rows)
+			last_id = bets[-1][0]
+
+		# Swap
+		db.session.execute('DELETE FROM points')
+		db.session.execute(
+			'INSERT INTO points (user_id, match_id, goals, wins, ties, corrects, total) '
+			'SELECT user_id, match_id, goals, wins, ties, corrects, total FROM points_rescore'
+		)
+		_rebuild_standings()
+		set_version('rules', rules.version)
+		db.session.commit()
+	finally:
+		db.session.rollback()
+		db.session.execute('DROP TABLE IF EXISTS points_rescore')
+		db.session.commit()
+	return scored
+
+def dedupe_bets():
+	'''
+	Remove duplicate bets and points of the same user and match
+	and add the unique index bets need for the upsert
+	The newest bet of every duplicate is kept and scored again
+	Return the number of removed bets and points
+	'''
+	pairs = [
+		{'user_id': user_id, 'match_id': match_id}
+		for user_id, match_id in db.session.execute(
+			'SELECT user_id, match_id FROM bets GROUP BY user_id, match_id HAVING COUNT(*) > 1 '
+			'UNION SELECT user_id, match_id FROM points GROUP BY user_id, match_id HAVING COUNT(*) > 1'
+		)
+	]
+	bets = db.session.execute(
+		'DELETE FROM bets WHERE id NOT IN '
+		'(SELECT MAX(id) FROM bets GROUP BY user_id, match_id)'
+	).rowcount
+	points = 0
+	if pairs:
+		# Kept points may belong to a removed bet, score these again
+		points = db.session.execute(db.text(
+			'DELETE FROM points WHERE user_id = :user_id AND match_id = :match_id'
+		), pairs).rowcount
+		Match.query.filter(
+			Match.match_id.in_(set(pair['match_id'] for pair in pairs))
+		).update({'points_shared': 0}, synchronize_session=False)
+	db.session.execute(
+		'CREATE UNIQUE INDEX IF NOT EXISTS uq_bets_user_match ON bets (user_id, match_id)'
+	)
+	db.session.commit()
+	if pairs:
+		rebuild_standings()
+		check_points()
+	return bets, points
+
+_ranking_cache = common.VersionedCache()
+
+def get_ranking():
+	'''
+	Generate ranking list
+	Cached until the next time points are written
+	'''
+	version = get_version('scoring')
+	ranking = _ranking_cache.get(version, 'ranking')
+	if ranking is not None:
+		return ranking
+	standings = read_session.query(
+		Standing, User.id, User.username
+	).join(User, Standing.user_id == User.id).order_by(
+		Standing.total.desc(),
+		Standing.corrects.desc(),
+		Standing.ties.desc(),
+		Standing.wins.desc(),
+		Standing.goals.desc()
+	).all()
+	# Standings hold points, ties are shown as a count
+	tie = get_rule_set().tie or 1
+	ranking = dict()
+	nro = 1
+	for s, user_id, username in standings:
+		ranking[nro] = {
+			'user': {'id': user_id, 'username': username},
+			'goals': s.goals,
+			'wins': s.wins,
+			'ties': int(s.ties) / tie,
+			'corrects': s.corrects,
+			'total': s.total,
+			'bets': s.bets
+		}
 		nro += 1
+	_ranking_cache.set(version, 'ranking', ranking)
 	return ranking
 			
+def clear_caches():
+	''' Forget cached users, teams, ranking and calendars '''
+	with _user_cache_lock:
+		_user_cache.clear()
+	_team_cache.clear()
+	_ranking_cache.clear()
+	common._calendar_cache.clear()
+
 def add_result(match_id, user_id, home_goals, away_goals, played):
 	''' Adding new bet '''
 	match = get_match(match_id)
@@ -365,28 +1013,141 @@ def add_result(match_id, user_id, home_goals, away_goals, played):
 	match.away_goals = away_goals
 	match.played = played
 	db.session.add(match)
+	bump_match_months([match.match_time])
 	db.session.commit()
+	publish_score(match.match_id, home_goals, away_goals, played, match.overtime)
+
+def publish_score(match_id, home_goals, away_goals, played, overtime):
+	''' Tell connected clients about a changed result '''
+	events.broadcaster.publish('score', {
+		'match_id': match_id,
+		'home_goals': int(home_goals),
+		'away_goals': int(away_goals),
+		'played': bool(played),
+		'overtime': overtime
+	})
 	
-def add_results_auto():
-	loader = gameloader.Mestis(168, 425114685)
-	matches = loader.getMatches()
-	for match_id in matches:
-		if Match.query.filter_by(match_id=match_id).first():
-			result = matches[match_id]['Result'].split()[0].split('-')
-			played = 1 if matches[match_id]['GameStatus'] == '2' else 0
-			overtime = 1 if matches[match_id]['FinishedType'] != '1' else 0
-			thisMatch = get_match(match_id)
-			thisMatch.home_goals=result[0]
-			thisMatch.away_goals=result[1]
-			thisMatch.played=played
-			thisMatch.overtime=overtime
-			db.session.add(thisMatch)
-			db.session.commit()
+def get_loader():
+	''' Loader for all followed teams and seasons '''
+	return gameloader.MultiLoader(
+		app.config['MESTIS_TARGETS'],
+		workers=app.config['MESTIS_WORKERS'],
+		timeout=app.config['MESTIS_TIMEOUT']
+	)
+
+def add_results_auto(loader=None):
+	'''
+	Update results from the feed
+	Only changed matches are written, all in one transaction
+	Every played match without points is scored, also ones left
+	unscored by an earlier failed run
+	Return match ids of the newly finished matches
+	Raise gameloader.FeedError if no target of the feed could be loaded
+	'''
+	if loader is None:
+		loader = get_loader()
+	feed = dict()
+	for record in loader.getMatches().itervalues():
+		game = gameloader.Game.from_record(record)
+		feed[game.match_id] = game
+	app.logger.info('Feed loaded\n%s', loader.report())
+	if loader.errors and len(loader.errors) == len(loader.targets):
+		# Nothing to sync, the poller reports this as its last error
+		raise gameloader.FeedError(loader.report())
+	stored = db.session.query(
+		Match.id, Match.match_id, Match.match_time,
+		Match.home_goals, Match.away_goals, Match.played, Match.overtime
+	).all()
+	changed = list()
+	changed_ids = list()
+	changed_times = list()
+	finished = list()
+	for match in stored:
+		game = feed.get(match.match_id)
+		if game is None:
+			continue
+		result = (game.home_goals, game.away_goals, game.played, game.overtime)
+		fingerprint = (
+			match.home_goals, match.away_goals, int(bool(match.played)), match.overtime
+		)
+		if result == fingerprint:
+			continue
+		home_goals, away_goals, played, overtime = result
+		changed.append({
+			'id': match.id,
+			'home_goals': home_goals,
+			'away_goals': away_goals,
+			'played': played,
+			'overtime': overtime
+		})
+		changed_ids.append(match.match_id)
+		changed_times.append(match.match_time)
+		if played and not match.played:
+			finished.append(match.match_id)
+	if changed:
+		db.session.bulk_update_mappings(Match, changed)
+		bump_match_months(changed_times)
+		db.session.commit()
+		for match_id, match in zip(changed_ids, changed):
+			publish_score(
+				match_id, match['home_goals'], match['away_goals'],
+				match['played'], match['overtime']
+			)
 	check_points()
+	return finished
+
+# Schema migrations of existing databases, applied in order by migrate()
+# New tables are created by migrate() itself, migrations change old ones
+
+def _add_indexes():
+	''' Indexes of the hot lookups of bets, points, matches and users '''
+	for statement in (
+		'CREATE INDEX IF NOT EXISTS ix_bets_match_user ON bets (match_id, user_id)',
+		'CREATE INDEX IF NOT EXISTS ix_points_user_match ON points (user_id, match_id)',
+		'CREATE INDEX IF NOT EXISTS ix_matches_match_time ON matches (match_time)',
+		'CREATE INDEX IF NOT EXISTS ix_matches_home_team_id ON matches (home_team_id)',
+		'CREATE INDEX IF NOT EXISTS ix_matches_away_team_id ON matches (away_team_id)',
+		'CREATE INDEX IF NOT EXISTS ix_matches_played_shared ON matches (played, points_shared)',
+		'CREATE INDEX IF NOT EXISTS ix_users_email ON users (email)'
+	):
+		db.session.execute(statement)
+
+def _add_match_order_index():
+	''' Index of the calendar order, replaces the one of match time only '''
+	db.session.execute(
+		'CREATE INDEX IF NOT EXISTS ix_matches_time_match ON matches (match_time, match_id)'
+	)
+	db.session.execute('DROP INDEX IF EXISTS ix_matches_match_time')
+
+MIGRATIONS = [
+	dedupe_bets,
+	_add_indexes,
+	# Databases from before the standings table have points but no standings
+	_rebuild_standings,
+	_add_match_order_index
+]
+
+def get_schema_version():
+	''' Number of migrations applied to the database '''
+	return db.session.query(Version.value).filter_by(name='schema').scalar() or 0
+
+def migrate():
+	'''
+	Create missing tables and apply pending migrations
+	Every migration is committed together with the new schema version
+	Return the number of applied migrations
+	'''
+	db.create_all()
+	applied = get_schema_version()
+	for number, migration in enumerate(MIGRATIONS[applied:], applied + 1):
+		migration()
+		set_version('schema', number)
+		db.session.commit()
+	return max(len(MIGRATIONS) - applied, 0)
 
 def init():
 	''' Initialize the database '''
-	db.create_all()
+	migrate()
 	if not get_role('basic'):
 		# User roles
 		db.session.add(Role(name='basic'))
@@ -403,23 +1164,60 @@ def init():
 		db.session.add(user_master)
 		db.session.commit()
 		
-	loader = gameloader.Mestis(168, 425114685)
-	for team, team_id in loader.getTeams().iteritems():
-		if Team.query.filter_by(name=team).first() is None:
-			thisTeam = Team(name=team, team_id=team_id)
-			db.session.add(thisTeam)
-			db.session.commit()
-	matches = loader.getMatches()
-	for match_id in matches:
-		if Match.query.filter_by(match_id=match_id).first() is None:
-			dt = '{} {}'.format(matches[match_id]['GameDate'], matches[match_id]['GameTime'])
-			result = matches[match_id]['Result'].split()[0].split('-')
-			thisMatch = Match(
-				match_id=match_id,
-				home_team_id=matches[match_id]['HomeTeamID'],
-				away_team_id=matches[match_id]['AwayTeamID'],
-				match_time=common.set_timestamp(dt)
+	return import_season()
+
+def import_season(loader=None):
+	'''
+	Import new teams and matches from the feed
+	Everything is written with bulk inserts in one transaction
+	Return the number of inserted or renamed rows
+	'''
+	if loader is None:
+		loader = get_loader()
+	existing_teams = dict(db.session.query(Team.team_id, Team.name).all())
+	existing_matches = set(match_id for match_id, in db.session.query(Match.match_id))
+	teams = dict()
+	new_matches = list()
+	for game in loader.iterGames():
+		# Records may lack a team name, keep the one seen elsewhere
+		if game.home_team:
+			teams[game.home_team_id] = game.home_team
+		if game.away_team:
+			teams[game.away_team_id] = game.away_team
+		if game.match_id in existing_matches:
+			continue
+		new_matches.append({
+			'match_id': game.match_id,
+			'home_team_id': game.home_team_id,
+			'away_team_id': game.away_team_id,
+			'match_time': game.time,
+			'home_goals': 0,
+			'away_goals': 0,
+			'overtime': 0,
+			'played': False,
+			'points_shared': False
+		})
+	app.logger.info('Feed loaded\n%s', loader.report())
+
+	new_teams = list()
+	renamed_teams = 0
+	for team_id, name in teams.iteritems():
+		if not name:
+			continue
+		if team_id not in existing_teams:
+			new_teams.append({'team_id': team_id, 'name': name})
+		elif existing_teams[team_id] != name:
+			Team.query.filter_by(team_id=team_id).update(
+				{'name': name}, synchronize_session=False
 			)
-			db.session.add(thisMatch)
-			db.session.commit()
+			renamed_teams += 1
 
+	if new_teams:
+		db.session.bulk_insert_mappings(Team, new_teams)
+	if new_teams or renamed_teams:
+		bump_version('teams')
+	if new_matches:
+		db.session.bulk_insert_mappings(Match, new_matches)
+		bump_match_months([match['match_time'] for match in new_matches])
+	db.session.commit()
+	return len(new_teams) + renamed_teams + len(new_matches)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import Queue
+
+class Broadcaster(object):
+	'''
+	Fan out server-sent events to every client connected to this process
+	Events are published once and copied to the queue of every client
+	'''
+	def __init__(self, backlog=100, heartbeat=15):
+		'''
+		Keyword arguments:
+		backlog		-- events kept for a slow client before dropping them
+		heartbeat	-- seconds between keep-alive comments
+		'''
+		self.backlog = backlog
+		self.heartbeat = heartbeat
+		self._clients = set()
+		self._lock = threading.Lock()
+
+	def clients(self):
+		''' Number of connected clients '''
+		return len(self._clients)
+
+	def publish(self, event, data):
+		''' Send event with JSON data to all clients '''
+		message = 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+		with self._lock:
+			clients = list(self._clients)
+		for client in clients:
+			try:
+				client.put_nowait(message)
+			except Queue.Full:
+				pass
+
+	def stream(self):
+		''' Generator of messages for one client, ends when the client leaves '''
+		client = Queue.Queue(self.backlog)
+		with self._lock:
+			self._clients.add(client)
+		try:
+			yield 'retry: 5000\n\n'
+			while True:
+				try:
+					yield client.get(timeout=self.heartbeat)
+				except Queue.Empty:
+					yield ':\n\n'
+		finally:
+			with self._lock:
+				self._clients.discard(client)
+
+broadcaster = Broadcaster()
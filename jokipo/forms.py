@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from main import app
 import database
+from flask import request
 from flask.ext.wtf import Form
 from wtforms import StringField, HiddenField, PasswordField, SubmitField, BooleanField, IntegerField
 from wtforms.validators import Required, Email
@@ -31,8 +32,38 @@ class Bet(Form):
 	def __init__(self, match_id, home_id, away_id):
 		super(Bet, self).__init__()
 		self.match_id.data = match_id
-		self.home_goals.description = database.get_team(home_id).name
-		self.away_goals.description = database.get_team(away_id).name
+		self.home_goals.description = database.get_team_info(home_id).name
+		self.away_goals.description = database.get_team_info(away_id).name
+
+class MultiBet(Form):
+	'''
+	Betting form for many matches at once
+	Goals are posted as home_goals:<match_id> and away_goals:<match_id>
+	'''
+	submit = SubmitField(u'Veikkaa')
+
+	def bets(self):
+		'''
+		Return posted bets as list of (match_id, home_goals, away_goals)
+		and list of match ids with invalid values
+		'''
+		goals = dict()
+		for name, value in request.form.iteritems():
+			field, _, match_id = name.partition(':')
+			if field in ('home_goals', 'away_goals') and match_id.isdigit():
+				goals.setdefault(int(match_id), dict())[field] = value.strip()
+		bets = list()
+		invalid = list()
+		for match_id, values in sorted(goals.iteritems()):
+			home = values.get('home_goals', '')
+			away = values.get('away_goals', '')
+			if not home and not away:
+				continue
+			if home.isdigit() and away.isdigit():
+				bets.append((match_id, int(home), int(away)))
+			else:
+				invalid.append(match_id)
+		return bets, invalid
 
 class Result(Form):
 	''' Result form for admin user '''
@@ -46,8 +77,8 @@ class Result(Form):
 	def __init__(self, match_id, home_id, away_id):
 		super(Result, self).__init__()
 		self.match_id.data = match_id
-		self.home_goals.description = database.get_team(home_id).name
-		self.away_goals.description = database.get_team(away_id).name
+		self.home_goals.description = database.get_team_info(home_id).name
+		self.away_goals.description = database.get_team_info(away_id).name
 
 class ChangePassword(Form):
 	''' Change user password '''
@@ -1,12 +1,252 @@
 import urllib2
 import json
+import time
+import threading
+import Queue
+import os
+import zlib
+import hashlib
+import datetime
+import codecs
+
+class FeedError(Exception):
+	''' Raised when no target of the feed could be loaded '''
+
+class Game(object):
+	''' Compact, typed record of a single game in the feed '''
+	__slots__ = (
+		'match_id', 'home_team_id', 'home_team', 'away_team_id', 'away_team',
+		'time', 'home_goals', 'away_goals', 'status', 'finished_type'
+	)
+
+	@classmethod
+	def from_record(cls, record):
+		''' Build game from a record of the feed '''
+		game = cls()
+		game.match_id = int(record['UniqueID'])
+		game.home_team_id = int(record['HomeTeamID'])
+		game.home_team = record.get('HomeTeamName')
+		game.away_team_id = int(record['AwayTeamID'])
+		game.away_team = record.get('AwayTeamName')
+		game.time = datetime.datetime.strptime(
+			'{} {}'.format(record['GameDate'], record['GameTime']), '%d.%m.%Y %H:%M:%S'
+		)
+		result = (record.get('Result', '').split() or ['0-0'])[0].split('-')
+		try:
+			game.home_goals, game.away_goals = int(result[0]), int(result[1])
+		except (IndexError, ValueError):
+			game.home_goals, game.away_goals = 0, 0
+		game.status = int(record.get('GameStatus') or 0)
+		game.finished_type = int(record.get('FinishedType') or 1)
+		return game
+
+	@property
+	def played(self):
+		return 1 if self.status == 2 else 0
+
+	@property
+	def overtime(self):
+		return 1 if self.finished_type != 1 else 0
+
+	def __repr__(self):
+		return '<Game {}>'.format(self.match_id)
+
+class _GunzipStream(object):
+	''' Decompress gzipped response while reading it '''
+	def __init__(self, stream):
+		self.stream = stream
+		self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+	def read(self, size):
+		while True:
+			data = self.stream.read(size)
+			if not data:
+				return self.decompressor.flush()
+			data = self.decompressor.decompress(data)
+			if data:
+				return data
+
+def iter_json_array(stream, key=None, chunk_size=16384):
+	'''
+	Decode items of a JSON array one by one while reading the stream
+	Only the item being decoded is kept in memory
+
+	Keyword arguments:
+	stream		-- file-like object with read()
+	key			-- name of the array in the document, None for top level array
+	chunk_size	-- bytes read at once
+	'''
+	decoder = json.JSONDecoder()
+	text = codecs.getincrementaldecoder('utf-8')()
+	marker = u'"{}"'.format(key) if key else None
+	buf = u''
+	eof = False
+
+	def more(buf):
+		data = stream.read(chunk_size)
+		return buf + text.decode(data, not data), not data
+
+	# Find the start of the array
+	while True:
+		if marker:
+			found = buf.find(marker)
+			if found != -1:
+				# Only the part after the key is needed
+				buf = buf[found + len(marker):]
+				marker = None
+			else:
+				# Key may be split between two chunks
+				buf = buf[-len(marker):]
+		if not marker:
+			start = buf.find(u'[')
+			if start != -1:
+				buf = buf[start + 1:]
+				break
+			buf = u''
+		if eof:
+			return
+		buf, eof = more(buf)
+
+	pos = 0
+	while True:
+		while pos < len(buf) and buf[pos] in u' \t\r\n,':
+			pos += 1
+		if pos < len(buf) and buf[pos] == u']':
+			return
+		try:
+			if pos == len(buf):
+				raise ValueError('Need more data')
+			item, pos = decoder.raw_decode(buf, pos)
+		except ValueError:
+			if eof:
+				raise ValueError('Truncated JSON array')
+			buf, eof = more(buf[pos:])
+			pos = 0
+			continue
+		yield item
+
+class ResponseCache(object):
+	'''
+	Cache for downloaded pages, keyed by URL
+	Pages are kept in memory for the process lifetime and optionally on disk.
+	Cached pages are revalidated with If-None-Match/If-Modified-Since.
+	'''
+	def __init__(self, directory=None, max_age=0):
+		'''
+		Keyword arguments:
+		directory	-- folder for the disk copies, None keeps pages only in memory
+		max_age		-- seconds a page is used without asking the server
+		'''
+		self.directory = directory
+		self.max_age = max_age
+		self.hits = 0
+		self.misses = 0
+		self.not_modified = 0
+		self._entries = dict()
+		self._lock = threading.Lock()
+
+	def stats(self):
+		''' Counters for monitoring '''
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'not_modified': self.not_modified
+		}
+
+	def _path(self, url):
+		return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+	def _get(self, url):
+		''' Cached entry from memory or disk, None if there is none '''
+		with self._lock:
+			entry = self._entries.get(url)
+		if entry is not None or not self.directory:
+			return entry
+		path = self._path(url)
+		try:
+			with open(path + '.json') as f:
+				entry = json.load(f)
+			with open(path + '.body', 'rb') as f:
+				entry['body'] = f.read()
+		except (IOError, ValueError):
+			return None
+		# Disk copy always has to be revalidated
+		entry['fetched'] = 0
+		with self._lock:
+			self._entries[url] = entry
+		return entry
+
+	def _store(self, url, entry):
+		with self._lock:
+			self._entries[url] = entry
+		if not self.directory:
+			return
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		path = self._path(url)
+		with open(path + '.body.tmp', 'wb') as f:
+			f.write(entry['body'])
+		with open(path + '.json.tmp', 'w') as f:
+			json.dump({
+				'etag': entry['etag'],
+				'last_modified': entry['last_modified']
+			}, f)
+		os.rename(path + '.body.tmp', path + '.body')
+		os.rename(path + '.json.tmp', path + '.json')
+
+	def fetch(self, url, timeout):
+		'''
+		Return cache entry of the page
+		Entry holds 'body' and may hold the parsed data as 'parsed'
+		'''
+		entry = self._get(url)
+		if entry is not None and time.time() - entry['fetched'] < self.max_age:
+			self.hits += 1
+			return entry
+		req = urllib2.Request(url)
+		req.add_header('Accept-Encoding', 'gzip')
+		if entry is not None:
+			if entry['etag']:
+				req.add_header('If-None-Match', entry['etag'])
+			if entry['last_modified']:
+				req.add_header('If-Modified-Since', entry['last_modified'])
+		try:
+			response = urllib2.urlopen(req, timeout=timeout)
+		except urllib2.HTTPError as e:
+			if e.code != 304 or entry is None:
+				raise
+			self.not_modified += 1
+			entry['fetched'] = time.time()
+			return entry
+		body = response.read()
+		if response.info().get('Content-Encoding') == 'gzip':
+			body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+		self.misses += 1
+		entry = {
+			'etag': response.info().get('ETag'),
+			'last_modified': response.info().get('Last-Modified'),
+			'body': body,
+			'fetched': time.time()
+		}
+		self._store(url, entry)
+		return entry
 
 class GameLoader(object):
 	''' Class for loading the games and such things '''
+	# Seconds to wait for the webpage
+	timeout = 30
+	# Downloaded pages, shared by all loaders
+	cache = ResponseCache()
+	# Name of the games array in the feed, None for a top level array
+	games = None
+
+	def _load_entry(self):
+		''' Load data from the webpage through the response cache '''
+		return self.cache.fetch(self.url, self.timeout)
+
 	def _load_data(self):
 		''' Load data from the webpage '''
-		req = urllib2.Request(self.url)
-		return urllib2.urlopen(req).read()
+		return self._load_entry()['body']
 
 	def _json_to_dict(self, json_string):
 		''' Parse JSON string to dictionary	'''
@@ -34,12 +274,35 @@ class GameLoader(object):
 		return result
 
 	def getData(self):
-		''' Combines _load_data and _json_to_dict functions '''
-		return self._json_to_dict(self._load_data())
+		'''
+		Combines _load_data and _json_to_dict functions
+		The parsed data is reused while the page has not changed
+		'''
+		entry = self._load_entry()
+		if 'parsed' not in entry:
+			entry['parsed'] = self._json_to_dict(entry['body'])
+		return entry['parsed']
 
 	def getTeams(self):
 		''' Get team as dictionary '''
 		return self._picker(self.getData(), 'teams')
+
+	def iterGames(self):
+		'''
+		Yield games as Game records while downloading
+		Bypasses the response cache, memory use does not grow with the feed
+		'''
+		req = urllib2.Request(self.url)
+		req.add_header('Accept-Encoding', 'gzip')
+		response = urllib2.urlopen(req, timeout=self.timeout)
+		stream = response
+		if response.info().get('Content-Encoding') == 'gzip':
+			stream = _GunzipStream(response)
+		try:
+			for record in iter_json_array(stream, self.games):
+				yield Game.from_record(record)
+		finally:
+			response.close()
 	
 	def getMatches(self):
 		''' Get all games as dictionary '''
@@ -47,21 +310,22 @@ class GameLoader(object):
 
 
 class Mestis(GameLoader):
-	def __init__(self, groupid, team_id='', rink=''):
+	def __init__(self, groupid, team_id='', rink='', host='http://www.tilastopalvelu.fi'):
 		''' For Mestis
 		
 		Keyword arguments:
 		groupid	-- Identification number for season
 		team_id -- Every team has an unique ID number
 		rink	-- Rink ID of the rink where the match takes place
+		host	-- Address of the statistics service
 		'''
 		super(Mestis, self).__init__()
-		self._url(groupid, team_id, rink)
+		self._url(groupid, team_id, rink, host)
 		self._data()
 		
-	def _url(self, groupid, team_id, rink):
+	def _url(self, groupid, team_id, rink, host):
 		''' Generating URL '''
-		url = 'http://www.tilastopalvelu.fi'
+		url = host
 		url += '/ih/modules/mod_schedule/helper'
 		url += '/games.php'
 		url += '?statgroupid='+str(groupid)
@@ -84,6 +348,7 @@ class Mestis(GameLoader):
 		self.team_id = 'HomeTeamID'
 		self.team_name = 'HomeTeamName'
 		self.match_id = 'UniqueID'
+		self.games = 'games'
 		'''
 		NOTE
 		FinishedType
@@ -97,6 +362,165 @@ class Mestis(GameLoader):
 		 3	Cancelled??
 		'''
 
+class MultiLoader(object):
+	'''
+	Load several groupid/team_id targets concurrently
+	Games are merged by their unique id
+	'''
+	def __init__(self, targets, workers=4, timeout=30, loader=Mestis, **kwargs):
+		'''
+		Keyword arguments:
+		targets	-- list of (groupid, team_id) tuples
+		workers	-- maximum number of simultaneous downloads
+		timeout	-- seconds to wait for a single download
+		loader	-- GameLoader class used for every target
+		kwargs	-- passed to the loader, e.g. host
+		'''
+		self.targets = list(targets)
+		self.workers = workers
+		self.timeout = timeout
+		self.loader = loader
+		self.kwargs = kwargs
+		self.latency = dict()
+		self.errors = dict()
+
+	def _fetch(self, target):
+		''' Download and parse a single target '''
+		loader = self.loader(*target, **self.kwargs)
+		loader.timeout = self.timeout
+		start = time.time()
+		try:
+			return loader, loader.getData()
+		finally:
+			self.latency[target] = time.time() - start
+
+	def getData(self):
+		'''
+		Return list of (loader, data) for every target
+		Failed targets are left out and their errors stored in self.errors
+		'''
+		targets = Queue.Queue()
+		for target in self.targets:
+			targets.put(target)
+		results = list()
+		self.latency = dict()
+		self.errors = dict()
+
+		def work():
+			while True:
+				try:
+					target = targets.get_nowait()
+				except Queue.Empty:
+					return
+				try:
+					results.append(self._fetch(target))
+				except Exception as e:
+					self.errors[target] = e
+
+		threads = [
+			threading.Thread(target=work)
+			for i in range(min(self.workers, len(self.targets)))
+		]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return results
+
+	def report(self):
+		''' Latency or error of every target from the last load '''
+		lines = list()
+		for target in self.targets:
+			line = '{}/{}: {:.3f} s'.format(target[0], target[1], self.latency.get(target, 0))
+			if target in self.errors:
+				line += ' ({})'.format(self.errors[target])
+			lines.append(line)
+		lines.append('cache: {hits} hits, {misses} misses, {not_modified} not modified'.format(
+			**GameLoader.cache.stats()
+		))
+		return '\n'.join(lines)
+
+	def iterGames(self, buffered=1000):
+		'''
+		Yield games of all targets as Game records while downloading
+		Games seen already from another target are skipped
+
+		Keyword arguments:
+		buffered	-- maximum number of games waiting to be consumed
+		'''
+		targets = Queue.Queue()
+		for target in self.targets:
+			targets.put(target)
+		games = Queue.Queue(buffered)
+		done = object()
+		# Set when the consumer stops, also early
+		stop = threading.Event()
+		self.latency = dict()
+		self.errors = dict()
+
+		def put(item):
+			''' Queue item, return False if the consumer has stopped '''
+			while not stop.is_set():
+				try:
+					games.put(item, timeout=1)
+					return True
+				except Queue.Full:
+					pass
+			return False
+
+		def work():
+			while not stop.is_set():
+				try:
+					target = targets.get_nowait()
+				except Queue.Empty:
+					break
+				loader = self.loader(*target, **self.kwargs)
+				loader.timeout = self.timeout
+				start = time.time()
+				try:
+					for game in loader.iterGames():
+						if not put(game):
+							break
+				except Exception as e:
+					self.errors[target] = e
+				finally:
+					self.latency[target] = time.time() - start
+			put(done)
+
+		threads = [
+			threading.Thread(target=work)
+			for i in range(min(self.workers, len(self.targets)))
+		]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		seen = set()
+		running = len(threads)
+		try:
+			while running:
+				game = games.get()
+				if game is done:
+					running -= 1
+				elif game.match_id not in seen:
+					seen.add(game.match_id)
+					yield game
+		finally:
+			stop.set()
+
+	def getTeams(self):
+		''' Get teams of all targets as dictionary '''
+		result = dict()
+		for loader, data in self.getData():
+			result.update(loader._picker(data, 'teams'))
+		return result
+
+	def getMatches(self):
+		''' Get games of all targets as dictionary '''
+		result = dict()
+		for loader, data in self.getData():
+			result.update(loader._picker(data, 'matches'))
+		return result
+
 if __name__ == '__main__':
 	gameloader = Mestis(168)
 	matches = gameloader.getMatches()
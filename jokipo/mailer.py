@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import smtplib
+import threading
+import Queue
+from main import app, mail
+
+class MailWorker(object):
+	'''
+	Send queued mail in batches over one persistent SMTP connection
+	The connection is closed after the queue has been idle for a while
+	'''
+	def __init__(self, maxsize=100, batch=20, retries=3, backoff=2, idle=30):
+		'''
+		Keyword arguments:
+		maxsize	-- messages waiting at most, more are refused
+		batch	-- messages sent at most in one go
+		retries	-- attempts for a batch after the first one
+		backoff	-- seconds to wait after the first failure, doubled every time
+		idle	-- seconds without mail before the connection is closed
+		'''
+		self.queue = Queue.Queue(maxsize)
+		self.batch = batch
+		self.retries = retries
+		self.backoff = backoff
+		self.idle = idle
+		self.sent = 0
+		self.failed = 0
+		self.last_latency = None
+		self._connection = None
+		self._thread = None
+		self._lock = threading.Lock()
+
+	def stats(self):
+		''' Counters for monitoring '''
+		return {
+			'queue_depth': self.queue.qsize(),
+			'sent': self.sent,
+			'failed': self.failed,
+			'last_latency': self.last_latency
+		}
+
+	def send(self, msg):
+		''' Queue message, return False if the queue is full '''
+		self._start()
+		try:
+			self.queue.put_nowait(msg)
+		except Queue.Full:
+			app.logger.error('Mail queue full, message to %s dropped', msg.recipients)
+			return False
+		return True
+
+	def _start(self):
+		with self._lock:
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = threading.Thread(target=self._run, name='mail-worker')
+				self._thread.daemon = True
+				self._thread.start()
+
+	def _run(self):
+		with app.app_context():
+			while True:
+				try:
+					msg = self.queue.get(timeout=self.idle)
+				except Queue.Empty:
+					self._close()
+					msg = self.queue.get()
+				batch = [msg]
+				while len(batch) < self.batch:
+					try:
+						batch.append(self.queue.get_nowait())
+					except Queue.Empty:
+						break
+				self._send_batch(batch)
+
+	def _connect(self):
+		if self._connection is None:
+			self._connection = mail.connect().__enter__()
+		return self._connection
+
+	def _close(self):
+		if self._connection is not None:
+			try:
+				self._connection.__exit__(None, None, None)
+			except (smtplib.SMTPException, socket.error):
+				pass
+			self._connection = None
+
+	def _send_batch(self, batch):
+		'''
+		Send messages, reconnecting and backing off on connection errors
+		A message refused for good is dropped and the rest are sent
+		'''
+		start = time.time()
+		failed = self.failed
+		for attempt in range(self.retries + 1):
+			try:
+				connection = self._connect()
+				while batch:
+					try:
+						connection.send(batch[0])
+						self.sent += 1
+					except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+						if not _permanent(e):
+							raise
+						app.logger.error('Mail to %s dropped: %s', batch[0].recipients, e)
+						self.failed += 1
+					batch.pop(0)
+				break
+			except (smtplib.SMTPException, socket.error) as e:
+				app.logger.warning('Sending mail failed: %s', e)
+				self._close()
+				if attempt < self.retries:
+					time.sleep(self.backoff * 2 ** attempt)
+		self.failed += len(batch)
+		self.last_latency = time.time() - start
+		app.logger.info(
+			'Mail batch sent in %.3f s, %d failed, %d queued',
+			self.last_latency, self.failed - failed, self.queue.qsize()
+		)
+
+def _permanent(error):
+	''' True if sending the message again would fail the same way '''
+	if isinstance(error, smtplib.SMTPRecipientsRefused):
+		return True
+	return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+worker = MailWorker(
+	maxsize=app.config['MAIL_QUEUE_SIZE'],
+	batch=app.config['MAIL_BATCH_SIZE']
+)
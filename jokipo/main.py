@@ -11,7 +11,12 @@ app = Flask(__name__)
 mail = Mail()
 auth = Blueprint('auth', __name__)
 
-import configuration, forms, database, views
+import configuration, metrics, forms, database, views, poller, api
+
+app.register_blueprint(api.api, url_prefix='/api/v1')
 
 login_manager.init_app(app)
 mail.init_app(app)
+
+if app.config['RESULT_POLLER']:
+	poller.poller.start()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+Per request instrumentation
+
+Time spent in SQL, template rendering and password hashing is summed for
+every request and exported per endpoint as Prometheus histograms.
+Requests slower than SLOW_REQUEST_THRESHOLD are logged with their
+slowest statements.
+'''
+import time
+import threading
+import contextlib
+import jinja2
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from main import app
+
+# Upper bounds of the histogram buckets
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Histogram(object):
+	''' Prometheus histogram with one series per endpoint '''
+	def __init__(self, name, description, buckets):
+		self.name = name
+		self.description = description
+		self.buckets = buckets
+		self._series = dict()
+		self._lock = threading.Lock()
+
+	def observe(self, endpoint, value):
+		with self._lock:
+			series = self._series.get(endpoint)
+			if series is None:
+				series = self._series[endpoint] = [[0] * len(self.buckets), 0, 0.0]
+			counts = series[0]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[i] += 1
+			series[1] += 1
+			series[2] += value
+
+	def render(self):
+		''' Lines of the Prometheus text format '''
+		lines = [
+			'# HELP {} {}'.format(self.name, self.description),
+			'# TYPE {} histogram'.format(self.name)
+		]
+		with self._lock:
+			series = sorted((endpoint, list(s[0]), s[1], s[2]) for endpoint, s in self._series.iteritems())
+		for endpoint, counts, count, total in series:
+			for bound, bucket in zip(self.buckets, counts):
+				lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(self.name, endpoint, bound, bucket))
+			lines.append('{}_bucket{{endpoint="{}",le="+Inf"}} {}'.format(self.name, endpoint, count))
+			lines.append('{}_count{{endpoint="{}"}} {}'.format(self.name, endpoint, count))
+			lines.append('{}_sum{{endpoint="{}"}} {}'.format(self.name, endpoint, total))
+		return lines
+
+histograms = [
+	Histogram('jokipo_request_seconds', 'Total request latency', SECONDS),
+	Histogram('jokipo_request_sql_seconds', 'Time spent in SQL per request', SECONDS),
+	Histogram('jokipo_request_render_seconds', 'Time spent rendering templates per request', SECONDS),
+	Histogram('jokipo_request_password_seconds', 'Time spent hashing passwords per request', SECONDS),
+	Histogram('jokipo_request_queries', 'SQL statements per request', QUERIES)
+]
+
+def _current():
+	''' Counters of the current request, None outside of requests '''
+	if has_request_context():
+		return getattr(g, '_metrics', None)
+
+def add(kind, seconds):
+	''' Add time spent in sql, render or password to the current request '''
+	current = _current()
+	if current is not None:
+		current[kind] += seconds
+
+@contextlib.contextmanager
+def timed(kind):
+	''' Add the time spent in the block to the current request '''
+	start = time.time()
+	try:
+		yield
+	finally:
+		add(kind, time.time() - start)
+
+class TimedTemplate(jinja2.Template):
+	''' Jinja template which adds its render time to the current request '''
+	def render(self, *args, **kwargs):
+		with timed('render'):
+			return jinja2.Template.render(self, *args, **kwargs)
+
+app.jinja_env.template_class = TimedTemplate
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+	conn.info.setdefault('metrics_start', []).append(time.time())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+	elapsed = time.time() - conn.info['metrics_start'].pop()
+	current = _current()
+	if current is not None:
+		current['sql'] += elapsed
+		current['queries'] += 1
+		current['statements'].append((elapsed, statement))
+
+@event.listens_for(Engine, 'handle_error')
+def _execute_failed(context):
+	starts = context.connection.info.get('metrics_start')
+	if starts:
+		starts.pop()
+
+@app.before_request
+def _start_request():
+	g._metrics = {
+		'start': time.time(),
+		'sql': 0.0,
+		'render': 0.0,
+		'password': 0.0,
+		'queries': 0,
+		'statements': []
+	}
+
+@app.after_request
+def _end_request(response):
+	current = _current()
+	if current is None:
+		return response
+	total = time.time() - current['start']
+	endpoint = request.endpoint or 'unknown'
+	for histogram, value in zip(histograms, (
+		total, current['sql'], current['render'], current['password'], current['queries']
+	)):
+		histogram.observe(endpoint, value)
+	threshold = app.config['SLOW_REQUEST_THRESHOLD']
+	if threshold is not None and total > threshold:
+		slowest = sorted(current['statements'], reverse=True)[:app.config['SLOW_REQUEST_STATEMENTS']]
+		app.logger.warning(
+			'Slow request %s %s: %.3f s, %d queries in %.3f s, render %.3f s, password %.3f s%s',
+			request.method, request.path, total, current['queries'], current['sql'],
+			current['render'], current['password'],
+			''.join('\n  %.3f s %s' % (elapsed, ' '.join(statement.split())) for elapsed, statement in slowest)
+		)
+	return response
+
+def render(values=None):
+	'''
+	Request histograms and other values in the Prometheus text format
+
+	Keyword arguments:
+	values	-- dictionary of metric name: (counter or gauge, description, value)
+	'''
+	lines = list()
+	for histogram in histograms:
+		lines.extend(histogram.render())
+	for name, (kind, description, value) in sorted((values or {}).iteritems()):
+		if value is None:
+			continue
+		lines.append('# HELP {} {}'.format(name, description))
+		lines.append('# TYPE {} {}'.format(name, kind))
+		lines.append('{} {}'.format(name, value))
+	return '\n'.join(lines) + '\n'
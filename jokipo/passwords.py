@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import hmac
+import time
+import threading
+import multiprocessing
+import bcrypt
+import metrics
+from main import app
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _hashpw(password, salt):
+	return bcrypt.hashpw(password, salt)
+
+def _new_hash(password, rounds):
+	return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _run(func, *args):
+	'''
+	Run bcrypt work in the process pool, keeping the request thread free
+	Runs in this thread when BCRYPT_POOL_SIZE is 0
+	'''
+	global _pool
+	size = app.config['BCRYPT_POOL_SIZE']
+	with metrics.timed('password'):
+		if not size:
+			return func(*args)
+		if _pool is None:
+			with _pool_lock:
+				if _pool is None:
+					_pool = multiprocessing.Pool(size)
+		return _pool.apply_async(func, args).get(app.config['BCRYPT_TIMEOUT'])
+
+def get_rounds(pwhash):
+	''' Cost factor of a bcrypt hash, 0 if it can not be read '''
+	try:
+		return int(pwhash.split('$')[2])
+	except (AttributeError, IndexError, ValueError):
+		return 0
+
+def hash_password(password):
+	''' Return new hash of password with the configured cost factor '''
+	return _run(_new_hash, password.encode('utf8'), app.config['BCRYPT_ROUNDS'])
+
+def check_password(password, pwhash):
+	''' Check password against hash in constant time '''
+	if not pwhash:
+		return False
+	pwhash = pwhash.encode('utf8')
+	try:
+		actual = _run(_hashpw, password.encode('utf8'), pwhash)
+	except ValueError:
+		# Not a valid bcrypt hash
+		return False
+	return hmac.compare_digest(actual, pwhash)
+
+def needs_rehash(pwhash):
+	''' True if hash was made with a lower cost factor than configured '''
+	return get_rounds(pwhash) < app.config['BCRYPT_ROUNDS']
+
+def measure(concurrency=10, count=100):
+	'''
+	Measure password check latency under concurrent load
+	Return latencies in seconds as dictionary of percentiles
+	'''
+	pwhash = hash_password(u'salasana')
+	latencies = list()
+	lock = threading.Lock()
+	left = [count]
+
+	def work():
+		while True:
+			with lock:
+				if not left[0]:
+					return
+				left[0] -= 1
+			start = time.time()
+			check_password(u'salasana', pwhash)
+			elapsed = time.time() - start
+			with lock:
+				latencies.append(elapsed)
+
+	threads = [threading.Thread(target=work) for i in range(concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	latencies.sort()
+	return {
+		'p50': latencies[int(len(latencies) * 0.50)],
+		'p95': latencies[int(len(latencies) * 0.95)],
+		'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+		'max': latencies[-1]
+	}
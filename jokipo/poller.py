@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import fcntl
+import datetime
+import threading
+import common
+import database
+from main import app
+
+class SyncLock(object):
+	'''
+	Lock which keeps two result syncs from running at the same time,
+	in this process or any other process using the same lock file
+	'''
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._file = None
+
+	def acquire(self):
+		''' Return True if the lock was free and is now held '''
+		if not self._lock.acquire(False):
+			return False
+		self._file = open(self.path, 'a')
+		try:
+			fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			self._file.close()
+			self._lock.release()
+			return False
+		return True
+
+	def release(self):
+		fcntl.flock(self._file, fcntl.LOCK_UN)
+		self._file.close()
+		self._lock.release()
+
+sync_lock = SyncLock(app.config['SYNC_LOCK_FILE'])
+
+def run_sync():
+	'''
+	Run one result sync unless one is running already
+	Return ids of the newly finished matches, None if skipped
+	'''
+	if not sync_lock.acquire():
+		return None
+	try:
+		return database.add_results_auto()
+	finally:
+		sync_lock.release()
+
+def score_points():
+	'''
+	Score played matches unless a result sync or a rescore is running
+	Return the number of scored bets, None if skipped
+	'''
+	if not sync_lock.acquire():
+		return None
+	try:
+		return database.check_points()
+	finally:
+		sync_lock.release()
+
+def read_status():
+	''' Status last saved by the poller of any process, None if none has run '''
+	try:
+		with open(app.config['POLL_STATUS_FILE']) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return None
+
+class ResultPoller(object):
+	'''
+	Poll the feed for results in the background
+	Polls often while matches are running or have just ended,
+	otherwise sleeps until the next match or the slow interval
+	'''
+	def __init__(self, sync=run_sync, clock=common.timestamp, timer=time.time,
+			fast=None, slow=None, live=None):
+		'''
+		Keyword arguments:
+		sync	-- function running one sync
+		clock	-- function returning current local time as datetime
+		timer	-- function returning seconds, for measuring latency
+		fast	-- seconds between polls while matches are live
+		slow	-- longest sleep when no match is live
+		live	-- seconds from match start during which it counts as live
+		'''
+		self.sync = sync
+		self.clock = clock
+		self.timer = timer
+		self.fast = fast or app.config['POLL_FAST']
+		self.slow = slow or app.config['POLL_SLOW']
+		self.live = datetime.timedelta(seconds=live or app.config['POLL_LIVE'])
+		self.state = 'idle'
+		self.last_run = None
+		self.last_latency = None
+		self.last_error = None
+		self.next_wakeup = None
+		self._stop = threading.Event()
+		self._thread = None
+
+	def interval(self, now):
+		''' Seconds to wait before the next poll '''
+		if database.count_matches_between(now - self.live, now):
+			return self.fast
+		next_match = database.get_next_match_time(now)
+		if next_match is None:
+			return self.slow
+		return max(self.fast, min(self.slow, (next_match - now).total_seconds()))
+
+	def step(self):
+		'''
+		Poll once if it is time to
+		Return seconds until the next wake-up
+		'''
+		now = self.clock()
+		if self.next_wakeup is None or now >= self.next_wakeup:
+			self.state = 'syncing'
+			self.save()
+			start = self.timer()
+			try:
+				self.sync()
+				self.last_error = None
+			except Exception as e:
+				self.last_error = repr(e)
+				app.logger.exception('Result sync failed')
+			finally:
+				database.db.session.remove()
+			self.last_latency = self.timer() - start
+			self.last_run = now
+			now = self.clock()
+			self.next_wakeup = now + datetime.timedelta(seconds=self.interval(now))
+			database.db.session.remove()
+		self.state = 'sleeping'
+		self.save()
+		return max(0, (self.next_wakeup - now).total_seconds())
+
+	def status(self):
+		''' Current state for monitoring '''
+		return {
+			'state': self.state,
+			'last_run': self.last_run.isoformat() if self.last_run else None,
+			'last_latency': self.last_latency,
+			'last_error': self.last_error,
+			'next_wakeup': self.next_wakeup.isoformat() if self.next_wakeup else None
+		}
+
+	def save(self):
+		''' Write status to the file read by every process, see read_status '''
+		path = app.config['POLL_STATUS_FILE']
+		temp = '{}.{}'.format(path, os.getpid())
+		try:
+			with open(temp, 'w') as f:
+				json.dump(self.status(), f)
+			os.rename(temp, path)
+		except (IOError, OSError):
+			app.logger.exception('Could not save poller status')
+
+	def run(self):
+		''' Poll until stopped '''
+		while not self._stop.is_set():
+			# A context per step, its teardown removes the read session and
+			# versions cached in g such as the active rule set are read again
+			with app.app_context():
+				wait = self.step()
+			self._stop.wait(wait)
+		self.state = 'stopped'
+		self.save()
+
+	def start(self):
+		''' Run in a background thread '''
+		self._stop.clear()
+		self._thread = threading.Thread(target=self.run, name='result-poller')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		if self._thread:
+			self._thread.join()
+
+poller = ResultPoller()
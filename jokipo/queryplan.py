@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''
+Query plan checks for the query functions of database
+
+Every statement a function runs is explained with EXPLAIN QUERY PLAN.
+A plain table scan, one not using any index, is reported as a failure
+unless the function is meant to read the whole table.
+Functions are run on a temporary database of generated data, so the
+ones which write can be checked too.
+'''
+import datetime
+from sqlalchemy import event
+from main import app
+import database
+import benchmark
+
+db = database.db
+
+# Tables read whole on purpose, by check name
+ALLOWED_SCANS = {
+	'get_teams': ('teams',),
+	'get_users': ('users',),
+	# Stored results are compared with the whole feed
+	'add_results_auto': ('matches',),
+	# The swap copies every staged row
+	'rescore': ('points', 'points_rescore')
+}
+
+class _EmptyFeed(object):
+	''' Loader of a feed without games, add_results_auto only scores '''
+	targets = ()
+	errors = dict()
+
+	def getMatches(self):
+		return dict()
+
+	def report(self):
+		return ''
+
+def _checks():
+	''' Query functions and their arguments as (name, function, args) '''
+	dt = datetime.datetime(2016, 9, 3, 18, 30)
+	points = {'user_id': 1, 'match_id': 1, 'goals': 1, 'wins': 1, 'ties': 0, 'corrects': 0, 'total': 2}
+	return [
+		('get_role', database.get_role, ('basic',)),
+		('get_version', database.get_version, ('scoring',)),
+		('get_user_by_id', database.get_user_by_id, (1,)),
+		('get_user_by_name', database.get_user_by_name, ('user1',)),
+		('get_user_by_email', database.get_user_by_email, ('user1@example.com',)),
+		('get_users', database.get_users, ()),
+		('get_teams', database.get_teams, ()),
+		('get_team', database.get_team, (1,)),
+		('get_matches(played)', database.get_matches, (1,)),
+		('get_matches(not played)', database.get_matches, (0,)),
+		('get_matches_by_team', database.get_matches_by_team, (1,)),
+		('get_matches_by_month', database.get_matches_by_month, (dt,)),
+		('count_matches_between', database.count_matches_between, (dt, dt)),
+		('get_next_match_time', database.get_next_match_time, (dt,)),
+		('get_match', database.get_match, (1,)),
+		('get_bet', database.get_bet, (1, 1)),
+		('get_all_bets', database.get_all_bets, (1, True)),
+		('get_user_bets_all', database.get_user_bets_all, (1,)),
+		('get_user_bets_by_match', database.get_user_bets_by_match, (1, [1, 2])),
+		('get_user_bets_with_points', database.get_user_bets_with_points, (1, (dt, 1), 50)),
+		('add_bets', database.add_bets, (1, [(20, 1, 2)], dt)),
+		('check_points', database.check_points, ()),
+		('update_standings', database.update_standings, ([points],)),
+		('add_results_auto', database.add_results_auto, (_EmptyFeed(),)),
+		('rescore', database.rescore, ()),
+		('get_points', database.get_points, (1, 1)),
+		('get_ranking', database.get_ranking, ())
+	]
+
+def _table_scans(name, plan):
+	''' Plan rows which read a whole table without an index '''
+	allowed = ALLOWED_SCANS.get(name, ())
+	scans = list()
+	for row in plan:
+		detail = row[-1]
+		if detail.startswith('SCAN ') and ' USING ' not in detail:
+			if detail.startswith(('SCAN CONSTANT', 'SCAN SUBQUERY')):
+				continue
+			if detail.split()[1] not in allowed:
+				scans.append(detail)
+	return scans
+
+def explain(func, *args):
+	'''
+	Run func and explain every statement it sent to SQL
+	Return list of (statement, plan rows)
+	'''
+	statements = list()
+	def record(conn, cursor, statement, parameters, context, executemany):
+		if statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+			statements.append((statement, parameters[0] if executemany else parameters))
+	engines = set([db.engine, db.get_read_engine()])
+	for engine in engines:
+		event.listen(engine, 'before_cursor_execute', record)
+	try:
+		func(*args)
+	finally:
+		for engine in engines:
+			event.remove(engine, 'before_cursor_execute', record)
+	plans = list()
+	connection = db.engine.raw_connection()
+	try:
+		cursor = connection.cursor()
+		for statement, parameters in statements:
+			try:
+				cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+			except database.sqlite3.OperationalError:
+				# Tables a function creates and drops itself, e.g. staging
+				continue
+			plans.append((statement, cursor.fetchall()))
+	finally:
+		connection.close()
+	return plans
+
+def check():
+	'''
+	Explain all query functions on a generated temporary database
+	Return list of (name, statement, plan rows, table scans)
+	'''
+	results = list()
+	with benchmark.temporary_database():
+		with app.app_context():
+			benchmark.generate(users=20, teams=4, matches=20)
+		for name, func, args in _checks():
+			# A new context for each, nothing cached from the previous ones
+			with app.app_context():
+				for statement, plan in explain(func, *args):
+					results.append((name, statement, plan, _table_scans(name, plan)))
+				db.session.commit()
+	return results
@@ -1,8 +1,130 @@
 # -*- coding: utf-8 -*-
+import sys
+import time
 from flask.ext.script import Manager
 from main import app
+import database
+import poller
+import passwords
+import queryplan
+import benchmark
 manager = Manager(app)
 
+@manager.command
+def init_db():
+	''' Create tables and import teams and matches of followed seasons '''
+	start = time.time()
+	rows = database.init()
+	elapsed = time.time() - start
+	print '{} rows imported in {:.3f} s ({:.0f} rows/s)'.format(
+		rows, elapsed, rows / elapsed if elapsed else 0
+	)
+
+@manager.command
+def rebuild_standings():
+	''' Recompute the ranking table from points '''
+	users = database.rebuild_standings()
+	print '{} users ranked'.format(users)
+
+@manager.command
+def migrate():
+	''' Apply pending schema migrations '''
+	applied = database.migrate()
+	print '{} migrations applied, schema version {}'.format(
+		applied, database.get_schema_version()
+	)
+
+@manager.command
+def check_plans():
+	''' Fail if a query function reads a whole table without an index '''
+	failed = 0
+	for name, statement, plan, scans in queryplan.check():
+		print '{}: {}'.format(name, ', '.join(row[-1] for row in plan))
+		for scan in scans:
+			print '  table scan: {}'.format(scan)
+			failed += 1
+	if failed:
+		print '{} table scans found'.format(failed)
+		sys.exit(1)
+
+@manager.command
+def check_query_counts():
+	''' Fail if the number of queries of a page grows with the data '''
+	sizes = (50, 2500)
+	failed = 0
+	for page, counts in sorted(benchmark.page_query_counts(sizes).iteritems()):
+		print '{}: {} queries at {} bets'.format(
+			page, ', '.join(str(count) for count in counts),
+			', '.join(str(size) for size in sizes)
+		)
+		if len(set(counts)) > 1:
+			print '  query count grows with the data'
+			failed += 1
+	if failed:
+		print '{} pages with growing query counts'.format(failed)
+		sys.exit(1)
+
+@manager.option('-r', '--rules', dest='rules', type=int, default=None)
+@manager.option('-c', '--chunk', dest='chunk', type=int, default=5000)
+def rescore(rules, chunk):
+	''' Score all scored matches again, with another rule set if given '''
+	# Keep the poller from scoring new results in the middle
+	if not poller.sync_lock.acquire():
+		print 'Result sync is running, try again later'
+		sys.exit(1)
+	try:
+		start = time.time()
+		bets = database.rescore(rules, chunk)
+		elapsed = time.time() - start
+	finally:
+		poller.sync_lock.release()
+	print '{} bets scored with rules {} in {:.3f} s ({:.0f} bets/s)'.format(
+		bets, database.get_rule_set().version, elapsed, bets / elapsed if elapsed else 0
+	)
+
+@manager.command
+def poll():
+	''' Poll the feed for results until interrupted '''
+	poller.poller.run()
+
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=10)
+@manager.option('-n', '--count', dest='count', type=int, default=100)
+def login_latency(concurrency, count):
+	''' Measure password check latency under concurrent logins '''
+	result = passwords.measure(concurrency, count)
+	print 'cost {}, pool {}, {} checks by {} threads'.format(
+		app.config['BCRYPT_ROUNDS'], app.config['BCRYPT_POOL_SIZE'], count, concurrency
+	)
+	for key in ('p50', 'p95', 'p99', 'max'):
+		print '{}: {:.3f} s'.format(key, result[key])
+
+@manager.option('-r', '--readers', dest='readers', type=int, default=4)
+@manager.option('-n', '--runs', dest='runs', type=int, default=3)
+@manager.option('-u', '--users', dest='users', type=int, default=300)
+@manager.option('-m', '--matches', dest='matches', type=int, default=300)
+def read_latency(readers, runs, users, matches):
+	''' Measure ranking and calendar latency during scoring for every SQLite profile '''
+	results = benchmark.reader_latency(readers, runs, users, matches)
+	print '{} readers, {} scoring runs of {} bets'.format(readers, runs, users * matches / 2)
+	for profile, phases in sorted(results.iteritems()):
+		for phase in ('idle', 'scoring'):
+			result = phases[phase]
+			print '{:<12} {:<8} {:>6} reads  p50 {:.4f} s  p95 {:.4f} s  max {:.4f} s  {} errors'.format(
+				profile, phase, result['reads'], result['p50'], result['p95'],
+				result['max'], result['errors']
+			)
+
+@manager.option('-s', '--sizes', dest='sizes', default='100,10000,100000')
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=3)
+@manager.option('-o', '--output', dest='output', default='benchmark.json')
+def benchmark_suite(sizes, repeat, output):
+	''' Time the hot paths on generated databases and save the results as JSON '''
+	sizes = [int(size) for size in sizes.split(',')]
+	for result in benchmark.run_suite(sizes, repeat, output):
+		print '{:<26} {:>7} bets  best {:.4f} s  median {:.4f} s  {:>4} queries'.format(
+			result['path'], result['bets'], result['best'], result['median'], result['queries']
+		)
+	print 'saved to {}'.format(output)
 
 if __name__ == "__main__":
 	manager.run()
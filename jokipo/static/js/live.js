@@ -0,0 +1,29 @@
+/* Live score and points updates from /events */
+(function () {
+	if (!window.EventSource) {
+		return;
+	}
+	function each(selector, matchId, callback) {
+		var elems = document.querySelectorAll(selector + '[data-match="' + matchId + '"]');
+		for (var i = 0; i < elems.length; i++) {
+			callback(elems[i]);
+		}
+	}
+	var events = new EventSource('/events');
+	events.addEventListener('score', function (e) {
+		var data = JSON.parse(e.data);
+		var text = ' ' + data.home_goals + '-' + data.away_goals;
+		if (data.overtime) {
+			text += data.overtime == 1 ? ' JA' : ' VL';
+		}
+		each('.score', data.match_id, function (elem) {
+			elem.textContent = text;
+		});
+	});
+	events.addEventListener('points', function (e) {
+		var data = JSON.parse(e.data);
+		each('.points_notice', data.match_id, function (elem) {
+			elem.innerHTML = 'Pisteet on jaettu! <a href="/ranking">Katso ranking</a><br />';
+		});
+	});
+})();
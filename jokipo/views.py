@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
-from flask import render_template, session, redirect, url_for, flash, request
+from flask import render_template, session, redirect, url_for, flash, request, make_response, \
+	stream_with_context, jsonify, abort
 from main import app, login_manager, mail, auth
-import forms, database, common
+import forms, database, common, poller, events, mailer, metrics
 from flask.ext.bootstrap import Bootstrap
 from flask.ext.login import login_required, login_user, logout_user, current_user
 from flask.ext.mail import Message
-from threading import Thread
 
 bootstrap = Bootstrap(app)
 
+# Templates read team names and logos from the team registry
+app.add_template_global(database.get_team_info, 'team')
+
 # Main menu items and settings
 main_menu = [
 	{
@@ -33,6 +36,9 @@ main_menu = [
 	}
 ]
 
+# Bets shown on one page of "Veikkaukseni"
+BETS_PER_PAGE = 50
+
 # Submenu items and settings
 subpages = {
 	common.MainMenuID.MYPAGE : {
@@ -40,6 +46,11 @@ subpages = {
 			'id'	: None,
 			'text'	: u'Tiedot',
 			'link'	: '/mypage'
+		},
+		'bets' : {
+			'id'	: 'bets',
+			'text'	: u'Veikkaukseni',
+			'link'	: '/mypage/bets'
 		}
 	},
 	common.MainMenuID.MATCHES : {
@@ -56,10 +67,6 @@ subpages = {
 	}
 }
 
-def send_async_email(app, msg):
-	with app.app_context():
-		mail.send(msg)
-
 def send_email(to, subject, template, **kwargs):
 	msg = Message(
 		app.config['FLASKY_MAIL_SUBJECT_PREFIX'] + subject,
@@ -67,9 +74,7 @@ def send_email(to, subject, template, **kwargs):
 		recipients=[to])
 	msg.body = render_template(template + '.txt', **kwargs)
 	msg.html = render_template(template + '.html', **kwargs)
-	thr = Thread(target=send_async_email, args=[app, msg])
-	thr.start()
-	return thr
+	return mailer.worker.send(msg)
 
 
 @app.route('/')
@@ -80,7 +85,7 @@ def index():
 		main_menu=main_menu,
 		sub_menu=False,
 		form=forms.Login(),
-		rules=common.Points()
+		rules=database.get_rule_set()
 	)
 
 @app.route('/user_login')
@@ -130,7 +135,7 @@ def _confirm(token, user=None):
 	if user:
 		this_user = user
 	else:
-		this_user = current_user
+		this_user = database.get_user_by_id(current_user.id)
 	this_user.confirm(token)
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -172,12 +177,26 @@ def my_page(subpage_id='default'):
 		if new_pw != new_pw_confirm:
 			flash(u'Salasanan vaihto ei onnistunut.')
 		elif current_user.check_password(current_pw):
-			current_user.set_password(new_pw)
-			database.db.session.add(current_user)
+			user = database.get_user_by_id(current_user.id)
+			user.set_password(new_pw)
+			database.db.session.add(user)
 			database.db.session.commit()
 			flash(u'Salasana muutettu')
 		else:
 			flash(u'Salasanan vaihto ei onnistunut.')
+
+	bets = next_page = None
+	if subpage_id == 'bets':
+		# One extra row tells if there is a next page
+		bets = database.get_user_bets_with_points(
+			current_user.id,
+			after=common.decode_cursor(request.args.get('after')),
+			limit=BETS_PER_PAGE + 1
+		)
+		if len(bets) > BETS_PER_PAGE:
+			bets = bets[:BETS_PER_PAGE]
+			last = bets[-1][1]
+			next_page = common.encode_cursor(last.match_time, last.match_id)
 		
 	return render_template(
 		'auth'+template+'.html',
@@ -185,18 +204,46 @@ def my_page(subpage_id='default'):
 		main_menu=main_menu,
 		sub_menu_id=subpage_id,
 		sub_menu=sub_menu,
-		form=form
+		form=form,
+		bets=bets,
+		next_page=next_page
 	)
 
+@app.route('/mypage/export')
+@login_required
+def my_bets_export():
+	user_id = current_user.id
+	def generate():
+		yield 'match_id;match_time;bet;result;points\n'
+		for bet, match, points in database.iter_user_bets_with_points(user_id):
+			yield '{};{};{}-{};{};{}\n'.format(
+				match.match_id,
+				match.match_time.strftime('%d.%m.%Y %H:%M'),
+				bet.home_goals, bet.away_goals,
+				'{}-{}'.format(match.home_goals, match.away_goals) if match.played else '',
+				points
+			)
+	response = app.response_class(stream_with_context(generate()), mimetype='text/csv')
+	response.headers['Content-Disposition'] = 'attachment; filename=veikkaukset.csv'
+	return response
+
 @app.route('/ranking')
 @login_required
 def ranking():
-	return render_template(
-		'auth/ranking.html',
-		main_menu_id=common.MainMenuID.RANKING,
-		main_menu=main_menu,
-		ranking=database.get_ranking()
-	)	
+	# Ranking changes only when points are written
+	etag = 'ranking-{}-{}'.format(database.get_version('scoring'), current_user.id)
+	if request.if_none_match.contains(etag):
+		response = app.response_class(status=304)
+	else:
+		response = make_response(render_template(
+			'auth/ranking.html',
+			main_menu_id=common.MainMenuID.RANKING,
+			main_menu=main_menu,
+			ranking=database.get_ranking()
+		))
+	response.set_etag(etag)
+	response.headers['Cache-Control'] = 'private, no-cache'
+	return response
 
 @app.route('/matches')
 @app.route('/matches/<int:year>/<int:month>')
@@ -225,10 +272,14 @@ def matches(year=None, month=None, subpage_id='default', filter=None):
 @login_required
 def matches_list(team_id=None):
 	sub_menu = subpages[common.MainMenuID.MATCHES]
+	teams = sorted(database.get_team_registry().values(), key=lambda team: team.name)
 	if team_id:
-		special = (database.get_teams(), database.get_matches_by_team(team_id))
+		special = (teams, database.get_matches_by_team(team_id))
 	else:
-		special = (database.get_teams(), database.get_matches(0))
+		special = (teams, database.get_matches(0))
+	mybets = database.get_user_bets_by_match(
+		current_user.id, [match.match_id for match in special[1]]
+	)
 
 	return render_template(
 		'auth/matches/list.html',
@@ -237,7 +288,9 @@ def matches_list(team_id=None):
 		sub_menu_id='list',
 		sub_menu=sub_menu,
 		special=special,
-		form=None
+		mybets=mybets,
+		now=common.timestamp(),
+		form=forms.MultiBet()
 	)
 	
 @app.route('/matches/match/<int:match_id>', methods=['POST', 'GET'])
@@ -248,8 +301,8 @@ def single_match(match_id):
 	
 	form = forms.Bet(
 		match.match_id,
-		match.home_team.team_id,
-		match.away_team.team_id
+		match.home_team_id,
+		match.away_team_id
 	)
 
 	if form.validate_on_submit():
@@ -268,11 +321,26 @@ def single_match(match_id):
 		sub_menu_id='default',
 		sub_menu=sub_menu,
 		match=match,
-		allbets=database.get_all_bets(match_id),
+		allbets=database.get_all_bets(match_id, eager=True),
 		mybet=database.get_bet(match_id, current_user.id),
 		form=form
 	)
 	
+@app.route('/events')
+@login_required
+def live_events():
+	if not app.config['LIVE_EVENTS']:
+		abort(404)
+	if events.broadcaster.clients() >= app.config['MAX_EVENT_CLIENTS']:
+		# Busy, the browser connects again after the retry delay
+		response = app.response_class('retry: 60000\n\n', status=503, mimetype='text/event-stream')
+		response.headers['Retry-After'] = '60'
+		return response
+	response = app.response_class(events.broadcaster.stream(), mimetype='text/event-stream')
+	response.headers['Cache-Control'] = 'no-cache'
+	response.headers['X-Accel-Buffering'] = 'no'
+	return response
+	
 @app.route('/teams')
 def teams():
 	user = database.get_user(session.get("logged_username"))
@@ -344,7 +412,8 @@ def result(id):
 		away_goals = form.away_goals.data
 		played = form.played.data
 		database.add_result(match_id, user.id, home_goals, away_goals, played)
-		database.check_points()
+		if poller.score_points() is None:
+			flash(u'Pisteitä lasketaan jo, tulos pisteytetään seuraavalla kerralla.')
 		return redirect(url_for('matches'))
 	return render_template(
 		'result.html',
@@ -366,26 +435,89 @@ def mybets():
 		mybets=user_bets
 	)
 
-@app.route('/multibet', methods=['POST', 'GET'])
+@app.route('/multibet', methods=['POST'])
 @login_required
 def multibet():
-	for val in request.values.items():
-		print val[0].split(":")[0], val[1]
-	return redirect(url_for('index'))
+	form = forms.MultiBet()
+	results = list()
+	if form.validate_on_submit():
+		bets, invalid = form.bets()
+		status = database.add_bets(current_user.id, bets)
+		status.update((match_id, 'invalid goals') for match_id in invalid)
+		for match_id, reason in sorted(status.iteritems()):
+			result = {'match_id': match_id, 'status': 'rejected' if reason else 'accepted'}
+			if reason:
+				result['reason'] = reason
+			results.append(result)
+	if request.is_xhr or request.accept_mimetypes.best == 'application/json':
+		return jsonify(bets=results)
+	accepted = len([result for result in results if result['status'] == 'accepted'])
+	flash(u'Veikkauksia tallennettu: {}'.format(accepted))
+	if accepted < len(results):
+		flash(u'Veikkauksia hylätty: {} (ottelu alkanut tai virheellinen tulos)'.format(
+			len(results) - accepted
+		))
+	return redirect(request.referrer or url_for('matches_list'))
 
 @app.route('/check_points')
 @login_required
 def check_points():
 	if current_user.role.name == 'admin':
-		database.check_points()
+		if poller.score_points() is None:
+			flash(u'Pisteitä lasketaan jo.')
 	return redirect(url_for('my_page'))
 
 @app.route('/autocheck')
 def autocheck():
 	if current_user.role.name == 'admin':
-		database.add_results_auto()
+		try:
+			if poller.run_sync() is None:
+				flash(u'Tuloksia päivitetään jo.')
+		except database.gameloader.FeedError:
+			flash(u'Tulospalveluun ei saatu yhteyttä.')
 	return redirect(url_for('matches'))
 
+@app.route('/autocheck/status')
+@login_required
+def autocheck_status():
+	if current_user.role.name != 'admin':
+		return redirect(url_for('matches'))
+	# The poller may run in another process, e.g. runserver.py poll
+	return jsonify(poller.read_status() or poller.poller.status())
+
+
+@app.route('/cachestats')
+@login_required
+def cache_stats():
+	if current_user.role.name != 'admin':
+		return redirect(url_for('matches'))
+	return jsonify(
+		users=database.get_user_cache_stats(),
+		feed=database.gameloader.GameLoader.cache.stats()
+	)
+
+@app.route('/metrics')
+def prometheus_metrics():
+	if request.remote_addr not in app.config['METRICS_ALLOWED_IPS']:
+		abort(404)
+	users = database.get_user_cache_stats()
+	feed = database.gameloader.GameLoader.cache.stats()
+	mail_stats = mailer.worker.stats()
+	polling = poller.read_status() or poller.poller.status()
+	values = {
+		'jokipo_user_cache_hits_total': ('counter', 'Session user cache hits', users['hits']),
+		'jokipo_user_cache_misses_total': ('counter', 'Session user cache misses', users['misses']),
+		'jokipo_user_cache_size': ('gauge', 'Users in the session user cache', users['size']),
+		'jokipo_feed_cache_hits_total': ('counter', 'Feed pages used without asking the server', feed['hits']),
+		'jokipo_feed_cache_misses_total': ('counter', 'Feed pages downloaded', feed['misses']),
+		'jokipo_feed_cache_not_modified_total': ('counter', 'Feed pages the server reported unchanged', feed['not_modified']),
+		'jokipo_mail_queue_depth': ('gauge', 'Mails waiting to be sent', mail_stats['queue_depth']),
+		'jokipo_mail_sent_total': ('counter', 'Mails sent', mail_stats['sent']),
+		'jokipo_mail_failed_total': ('counter', 'Mails dropped after retries', mail_stats['failed']),
+		'jokipo_poller_last_latency_seconds': ('gauge', 'Duration of the last result sync', polling['last_latency']),
+		'jokipo_event_clients': ('gauge', 'Connected live event streams', events.broadcaster.clients())
+	}
+	return app.response_class(metrics.render(values), mimetype='text/plain; version=0.0.4')
 
 @app.route('/autoinit')
 def autoinit():